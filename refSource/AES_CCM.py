@@ -10,6 +10,24 @@ For production use, please use a well-vetted library like 'cryptography'.
 """
 
 import math
+import sys
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; only the batch API needs it
+    np = None
+
+# @micropython.native / @micropython.viper are consumed by the MicroPython
+# compiler and are not runtime attributes, so they have to be written out
+# literally. On CPython they resolve to this stub and do nothing.
+MICROPYTHON = sys.implementation.name == "micropython"
+if not MICROPYTHON:
+    class micropython:
+        @staticmethod
+        def native(f):
+            return f
+
+        viper = native
 
 # ==============================================================================
 #  AES-128 Implementation (Required for CMAC and CCM)
@@ -131,6 +149,242 @@ class AES:
 
         return self._matrix2bytes(state)
 
+# ==============================================================================
+#  AES-128 T-table Engine
+#  SubBytes, ShiftRows and MixColumns fused into four 256-entry word tables.
+# ==============================================================================
+
+def _build_t_tables(s_box):
+    """Builds the encryption T-tables Te0..Te3 from the S-box."""
+    te0 = []
+    for s in s_box:
+        s2 = (((s << 1) ^ 0x1B) & 0xFF) if (s & 0x80) else (s << 1)
+        s3 = s2 ^ s
+        te0.append((s2 << 24) | (s << 16) | (s << 8) | s3)
+    te1 = [((w >> 8) | (w << 24)) & 0xFFFFFFFF for w in te0]
+    te2 = [((w >> 16) | (w << 16)) & 0xFFFFFFFF for w in te0]
+    te3 = [((w >> 24) | (w << 8)) & 0xFFFFFFFF for w in te0]
+    return tuple(te0), tuple(te1), tuple(te2), tuple(te3)
+
+
+class TTableAES(AES):
+    """
+    AES-128 using precomputed 32-bit round keys and T-tables.
+
+    Drop-in replacement for AES (same BLOCK_SIZE and encrypt_block), so it can
+    be passed as cipher_class to CMAC and CCM. The state is kept as four column
+    words instead of a 4x4 list, and the round keys are expanded only once.
+    """
+
+    # Built by the first instance rather than at import: 1024 32-bit words are
+    # heap ints on MicroPython, and the firmware normally never uses this class.
+    TE0 = TE1 = TE2 = TE3 = None
+
+    @classmethod
+    def _build_tables(cls):
+        if TTableAES.TE0 is None:
+            TTableAES.TE0, TTableAES.TE1, TTableAES.TE2, TTableAES.TE3 = _build_t_tables(AES.S_BOX)
+
+    def __init__(self, key: bytes):
+        self._build_tables()
+        super().__init__(key)
+        self._round_keys = tuple(int.from_bytes(w, 'big') for w in self._expanded_key)
+
+    def encrypt_block(self, plaintext: bytes) -> bytes:
+        if len(plaintext) != self.BLOCK_SIZE:
+            raise ValueError(f"Plaintext block must be {self.BLOCK_SIZE} bytes long.")
+
+        te0, te1, te2, te3 = self.TE0, self.TE1, self.TE2, self.TE3
+        rk = self._round_keys
+
+        s = int.from_bytes(plaintext, 'big')
+        s0 = (s >> 96) ^ rk[0]
+        s1 = ((s >> 64) & 0xFFFFFFFF) ^ rk[1]
+        s2 = ((s >> 32) & 0xFFFFFFFF) ^ rk[2]
+        s3 = (s & 0xFFFFFFFF) ^ rk[3]
+
+        for r in range(4, 4 * self.NUM_ROUNDS, 4):
+            t0 = te0[s0 >> 24] ^ te1[(s1 >> 16) & 0xFF] ^ te2[(s2 >> 8) & 0xFF] ^ te3[s3 & 0xFF] ^ rk[r]
+            t1 = te0[s1 >> 24] ^ te1[(s2 >> 16) & 0xFF] ^ te2[(s3 >> 8) & 0xFF] ^ te3[s0 & 0xFF] ^ rk[r + 1]
+            t2 = te0[s2 >> 24] ^ te1[(s3 >> 16) & 0xFF] ^ te2[(s0 >> 8) & 0xFF] ^ te3[s1 & 0xFF] ^ rk[r + 2]
+            t3 = te0[s3 >> 24] ^ te1[(s0 >> 16) & 0xFF] ^ te2[(s1 >> 8) & 0xFF] ^ te3[s2 & 0xFF] ^ rk[r + 3]
+            s0, s1, s2, s3 = t0, t1, t2, t3
+
+        # Final round: SubBytes + ShiftRows + AddRoundKey (no MixColumns)
+        sb = self.S_BOX
+        r = 4 * self.NUM_ROUNDS
+        o0 = ((sb[s0 >> 24] << 24) | (sb[(s1 >> 16) & 0xFF] << 16) | (sb[(s2 >> 8) & 0xFF] << 8) | sb[s3 & 0xFF]) ^ rk[r]
+        o1 = ((sb[s1 >> 24] << 24) | (sb[(s2 >> 16) & 0xFF] << 16) | (sb[(s3 >> 8) & 0xFF] << 8) | sb[s0 & 0xFF]) ^ rk[r + 1]
+        o2 = ((sb[s2 >> 24] << 24) | (sb[(s3 >> 16) & 0xFF] << 16) | (sb[(s0 >> 8) & 0xFF] << 8) | sb[s1 & 0xFF]) ^ rk[r + 2]
+        o3 = ((sb[s3 >> 24] << 24) | (sb[(s0 >> 16) & 0xFF] << 16) | (sb[(s1 >> 8) & 0xFF] << 8) | sb[s2 & 0xFF]) ^ rk[r + 3]
+
+        return ((o0 << 96) | (o1 << 64) | (o2 << 32) | o3).to_bytes(self.BLOCK_SIZE, 'big')
+
+# ==============================================================================
+#  Batched NumPy Backend
+#  Encrypts an (N, 16) uint8 array of blocks per call with the same T-tables,
+#  optionally with a different key per row. Used by the *_batch entry points.
+# ==============================================================================
+
+_NP_TABLES = None
+
+def _np_require():
+    if np is None:
+        raise ImportError("NumPy is required for the batch API.")
+
+def _np_tables():
+    """Returns (SBOX, TE0, TE1, TE2, TE3) as uint32 arrays, built on first use."""
+    global _NP_TABLES
+    _np_require()
+    if _NP_TABLES is None:
+        TTableAES._build_tables()
+        _NP_TABLES = tuple(np.array(t, dtype=np.uint32) for t in
+                           (AES.S_BOX, TTableAES.TE0, TTableAES.TE1, TTableAES.TE2, TTableAES.TE3))
+    return _NP_TABLES
+
+def _np_as_blocks(data, width: int = 16):
+    """Coerces bytes / a list of blocks / an array into a contiguous (N, width) uint8 array."""
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        arr = np.frombuffer(bytes(data), dtype=np.uint8)
+    elif isinstance(data, (list, tuple)):
+        arr = np.frombuffer(b"".join(data), dtype=np.uint8)
+    else:
+        arr = np.asarray(data, dtype=np.uint8)
+    arr = np.ascontiguousarray(arr).reshape(-1, width)
+    return arr
+
+def _np_expand_keys(keys):
+    """Expands an (N, 16) uint8 array of AES-128 keys into (N, 44) uint32 round-key words."""
+    sb = _np_tables()[0]
+    keys = _np_as_blocks(keys)
+    w = np.empty((keys.shape[0], 4 * (AES.NUM_ROUNDS + 1)), dtype=np.uint32)
+    w[:, :4] = keys.view('>u4')
+    for i in range(4, w.shape[1]):
+        temp = w[:, i - 1]
+        if i % 4 == 0:
+            temp = ((sb[(temp >> 16) & 0xFF] << 24) | (sb[(temp >> 8) & 0xFF] << 16) |
+                    (sb[temp & 0xFF] << 8) | sb[temp >> 24]) ^ np.uint32(AES.RCON[i // 4] << 24)
+        w[:, i] = w[:, i - 4] ^ temp
+    return w
+
+def _np_encrypt(round_keys, blocks):
+    """
+    Encrypts an (N, 16) uint8 array of blocks.
+    round_keys is (N, 44) for one key per row, or (1, 44) to use one key for all rows.
+    """
+    sb, te0, te1, te2, te3 = _np_tables()
+    blocks = _np_as_blocks(blocks)
+    rk = round_keys
+    s = blocks.view('>u4').astype(np.uint32)
+    s0 = s[:, 0] ^ rk[:, 0]
+    s1 = s[:, 1] ^ rk[:, 1]
+    s2 = s[:, 2] ^ rk[:, 2]
+    s3 = s[:, 3] ^ rk[:, 3]
+
+    for r in range(4, 4 * AES.NUM_ROUNDS, 4):
+        t0 = te0[s0 >> 24] ^ te1[(s1 >> 16) & 0xFF] ^ te2[(s2 >> 8) & 0xFF] ^ te3[s3 & 0xFF] ^ rk[:, r]
+        t1 = te0[s1 >> 24] ^ te1[(s2 >> 16) & 0xFF] ^ te2[(s3 >> 8) & 0xFF] ^ te3[s0 & 0xFF] ^ rk[:, r + 1]
+        t2 = te0[s2 >> 24] ^ te1[(s3 >> 16) & 0xFF] ^ te2[(s0 >> 8) & 0xFF] ^ te3[s1 & 0xFF] ^ rk[:, r + 2]
+        t3 = te0[s3 >> 24] ^ te1[(s0 >> 16) & 0xFF] ^ te2[(s1 >> 8) & 0xFF] ^ te3[s2 & 0xFF] ^ rk[:, r + 3]
+        s0, s1, s2, s3 = t0, t1, t2, t3
+
+    r = 4 * AES.NUM_ROUNDS
+    out = np.empty((blocks.shape[0], 4), dtype='>u4')
+    out[:, 0] = ((sb[s0 >> 24] << 24) | (sb[(s1 >> 16) & 0xFF] << 16) | (sb[(s2 >> 8) & 0xFF] << 8) | sb[s3 & 0xFF]) ^ rk[:, r]
+    out[:, 1] = ((sb[s1 >> 24] << 24) | (sb[(s2 >> 16) & 0xFF] << 16) | (sb[(s3 >> 8) & 0xFF] << 8) | sb[s0 & 0xFF]) ^ rk[:, r + 1]
+    out[:, 2] = ((sb[s2 >> 24] << 24) | (sb[(s3 >> 16) & 0xFF] << 16) | (sb[(s0 >> 8) & 0xFF] << 8) | sb[s1 & 0xFF]) ^ rk[:, r + 2]
+    out[:, 3] = ((sb[s3 >> 24] << 24) | (sb[(s0 >> 16) & 0xFF] << 16) | (sb[(s1 >> 8) & 0xFF] << 8) | sb[s2 & 0xFF]) ^ rk[:, r + 3]
+    return out.view(np.uint8).reshape(-1, AES.BLOCK_SIZE)
+
+
+class NumpyAES(TTableAES):
+    """
+    AES-128 with a vectorized encrypt_blocks() for (N, 16) uint8 arrays.
+
+    encrypt_block() is inherited from TTableAES, so this class also works as
+    cipher_class for the scalar CMAC/CCM paths. Requires NumPy.
+    """
+
+    def __init__(self, key: bytes):
+        _np_require()
+        super().__init__(key)
+        self._round_keys_np = np.array(self._round_keys, dtype=np.uint32).reshape(1, -1)
+
+    def encrypt_blocks(self, blocks):
+        """Encrypts an (N, 16) uint8 array (or bytes of length N*16). Returns an (N, 16) uint8 array."""
+        return _np_encrypt(self._round_keys_np, blocks)
+
+# ==============================================================================
+#  AES-128 In-place Engine (MicroPython)
+#  Byte-oriented rounds over preallocated bytearrays. After __init__ no call
+#  allocates: there are no 32-bit words (which are heap ints on MicroPython),
+#  no per-round lists and no new output objects when encrypt_into() is used.
+# ==============================================================================
+
+def _build_mul2():
+    return bytes((((i << 1) ^ 0x1B) & 0xFF) if (i & 0x80) else (i << 1) for i in range(256))
+
+
+class InPlaceAES(AES):
+    """
+    AES-128 that encrypts into a caller-supplied buffer.
+
+    encrypt_into(src, dst) reads 16 bytes from src and writes 16 bytes to dst
+    (they may be the same buffer) using only the scratch state allocated in
+    __init__. encrypt_block() is kept for the cipher_class interface.
+    """
+
+    SBOX_BYTES = bytes(AES.S_BOX)
+    MUL2 = _build_mul2()
+    # ShiftRows on the column-major state: out[4c + r] = in[4((c + r) % 4) + r]
+    SHIFT = bytes(4 * ((c + r) % 4) + r for c in range(4) for r in range(4))
+
+    def __init__(self, key: bytes):
+        super().__init__(key)
+        self._rk = bytearray(b"".join(self._expanded_key))
+        self._state = bytearray(self.BLOCK_SIZE)
+        self._tmp = bytearray(self.BLOCK_SIZE)
+
+    @micropython.native
+    def encrypt_into(self, src, dst):
+        sb = self.SBOX_BYTES
+        m2 = self.MUL2
+        sh = self.SHIFT
+        rk = self._rk
+        s = self._state
+        t = self._tmp
+
+        for i in range(16):
+            s[i] = src[i] ^ rk[i]
+
+        off = 16
+        for _ in range(self.NUM_ROUNDS - 1):
+            # SubBytes + ShiftRows
+            for i in range(16):
+                t[i] = sb[s[sh[i]]]
+            # MixColumns + AddRoundKey
+            for c in range(0, 16, 4):
+                a0 = t[c]
+                a1 = t[c + 1]
+                a2 = t[c + 2]
+                a3 = t[c + 3]
+                u = a0 ^ a1 ^ a2 ^ a3
+                s[c] = a0 ^ u ^ m2[a0 ^ a1] ^ rk[off + c]
+                s[c + 1] = a1 ^ u ^ m2[a1 ^ a2] ^ rk[off + c + 1]
+                s[c + 2] = a2 ^ u ^ m2[a2 ^ a3] ^ rk[off + c + 2]
+                s[c + 3] = a3 ^ u ^ m2[a3 ^ a0] ^ rk[off + c + 3]
+            off += 16
+
+        for i in range(16):
+            dst[i] = sb[s[sh[i]]] ^ rk[off + i]
+
+    def encrypt_block(self, plaintext: bytes) -> bytes:
+        if len(plaintext) != self.BLOCK_SIZE:
+            raise ValueError(f"Plaintext block must be {self.BLOCK_SIZE} bytes long.")
+        out = bytearray(self.BLOCK_SIZE)
+        self.encrypt_into(plaintext, out)
+        return bytes(out)
+
 # ==============================================================================
 #  Helper Functions
 # ==============================================================================
@@ -139,6 +393,28 @@ def xor_bytes(a: bytes, b: bytes) -> bytes:
     """Performs XOR operation on two byte strings."""
     return bytes(x ^ y for x, y in zip(a, b))
 
+if MICROPYTHON:
+    @micropython.viper
+    def xor_into(dst, a, b, n: int):
+        """dst[i] = a[i] ^ b[i] for i < n, without allocating (viper)."""
+        d = ptr8(dst)
+        x = ptr8(a)
+        y = ptr8(b)
+        for i in range(n):
+            d[i] = x[i] ^ y[i]
+else:
+    def xor_into(dst, a, b, n: int):
+        """dst[i] = a[i] ^ b[i] for i < n, without allocating."""
+        for i in range(n):
+            dst[i] = a[i] ^ b[i]
+
+def _np_double(blocks):
+    """CMAC subkey doubling (left shift, conditional XOR with Rb) on an (N, 16) uint8 array."""
+    shifted = (blocks << 1).astype(np.uint8)
+    shifted[:, :-1] |= blocks[:, 1:] >> 7
+    shifted[:, -1] ^= np.where(blocks[:, 0] & 0x80, 0x87, 0).astype(np.uint8)
+    return shifted
+
 def left_shift_bytes(data: bytes) -> bytes:
     """Performs a left bit shift on a byte string."""
     result = bytearray(len(data))
@@ -161,6 +437,7 @@ class CMAC:
     def __init__(self, key: bytes, cipher_class=AES):
         self.cipher = cipher_class(key)
         self.block_size = self.cipher.BLOCK_SIZE
+        self._key = bytes(key)
         
         # Generate subkeys K1 and K2
         const_zero = bytes(self.block_size)
@@ -196,7 +473,8 @@ class CMAC:
             is_padded = True
             last_block = self._pad(b'')
         else:
-            is_padded = (len(message) % self.block_size != 0)
+            # An empty message is padded to one full block and uses K2
+            is_padded = (len(message) == 0 or len(message) % self.block_size != 0)
             
             if not is_padded and len(message) > 0:
                 last_block_start = (num_blocks - 1) * self.block_size
@@ -223,6 +501,32 @@ class CMAC:
         
         return tag
 
+    def generate_batch(self, messages) -> list[bytes]:
+        """
+        Generates the CMAC tags for many messages under this key in one
+        vectorized pass. Requires NumPy. Results match generate().
+        """
+        _np_require()
+        return _np_cmac(_np_expand_keys(self._key), messages)
+
+    @classmethod
+    def generate_tokens(cls, keys, messages) -> list[bytes]:
+        """
+        Generates CMAC(keys[i], messages[i]) for every i in one vectorized pass,
+        e.g. the login tokens of many locks from their device secrets and
+        random codes. Requires NumPy.
+        """
+        _np_require()
+        if len(keys) != len(messages):
+            raise ValueError("keys and messages must have the same length.")
+        if not keys:
+            return []
+        return _np_cmac(_np_expand_keys(keys), messages)
+
+    def stream(self) -> "CMACStream":
+        """Returns an incremental CMAC object fed with update() and closed with finalize()."""
+        return CMACStream(self)
+
     def verify(self, message: bytes, tag: bytes) -> bool:
         """Verifies the CMAC tag for a given message."""
         generated_tag = self.generate(message)
@@ -236,6 +540,44 @@ class CMAC:
             result |= x ^ y
         return result == 0
 
+def _np_cmac(round_keys, messages) -> list[bytes]:
+    """
+    Vectorized CMAC. round_keys is (N, 44) for one key per message or (1, 44)
+    for a shared key. Messages are grouped by length so that each group runs
+    the same number of chained block encryptions.
+    """
+    bs = AES.BLOCK_SIZE
+    shared = round_keys.shape[0] == 1
+    l = _np_encrypt(round_keys, np.zeros((round_keys.shape[0], bs), dtype=np.uint8))
+    k1 = _np_double(l)
+    k2 = _np_double(k1)
+
+    groups = {}
+    for i, message in enumerate(messages):
+        groups.setdefault(len(message), []).append(i)
+
+    tags = [None] * len(messages)
+    for length, idx in groups.items():
+        rows = np.array(idx)
+        rk = round_keys if shared else round_keys[rows]
+        num_blocks = max(1, math.ceil(length / bs))
+        complete = length > 0 and length % bs == 0
+
+        buf = np.zeros((len(idx), num_blocks * bs), dtype=np.uint8)
+        if length:
+            buf[:, :length] = _np_as_blocks([bytes(messages[i]) for i in idx], length)
+        if not complete:
+            buf[:, length] = 0x80
+        subkey = k1 if complete else k2
+        buf[:, -bs:] ^= subkey if shared else subkey[rows]
+
+        x = np.zeros((len(idx), bs), dtype=np.uint8)
+        for j in range(num_blocks):
+            x = _np_encrypt(rk, x ^ buf[:, j * bs:(j + 1) * bs])
+        for row, i in enumerate(idx):
+            tags[i] = x[row].tobytes()
+    return tags
+
 # ==============================================================================
 #  CCM Implementation
 # ==============================================================================
@@ -253,6 +595,7 @@ class CCM:
         self.block_size = self.cipher.BLOCK_SIZE
         self.mac_len = mac_len
         self.nonce = nonce
+        self._key = bytes(key)
         
         # Check nonce length
         # L is the size in bytes of the message length field.
@@ -342,6 +685,26 @@ class CCM:
         
         return bytes(encrypted_data)
 
+    def ctr_crypt_batch(self, data: bytes) -> bytes:
+        """
+        Same result as _ctr_crypt(), but all counter blocks A_1..A_n are
+        encrypted in one vectorized call. Requires NumPy.
+        """
+        _np_require()
+        if not data:
+            return b""
+        num_blocks = math.ceil(len(data) / self.block_size)
+        counters = np.arange(1, num_blocks + 1, dtype=np.uint64)
+
+        a = np.zeros((num_blocks, self.block_size), dtype=np.uint8)
+        a[:, 0] = self.L - 1
+        a[:, 1:1 + len(self.nonce)] = np.frombuffer(self.nonce, dtype=np.uint8)
+        for k in range(self.L):
+            a[:, self.block_size - 1 - k] = (counters >> np.uint64(8 * k)) & np.uint64(0xFF)
+
+        keystream = _np_encrypt(_np_expand_keys(self._key), a).reshape(-1)[:len(data)]
+        return (np.frombuffer(data, dtype=np.uint8) ^ keystream).tobytes()
+
     def encrypt(self, plaintext: bytes, associated_data: bytes = b"") -> tuple[bytes, bytes]:
         """
         Encrypts plaintext and generates an authentication tag.
@@ -434,6 +797,465 @@ class CCM:
         else:
             return None
 
+    def encryptor(self, msg_len: int, associated_data: bytes = b"") -> "CCMStream":
+        """Returns an incremental encryptor for a message of msg_len bytes."""
+        return CCMStream(self, msg_len, associated_data, decrypt=False)
+
+    def decryptor(self, msg_len: int, associated_data: bytes = b"") -> "CCMStream":
+        """Returns an incremental decryptor for a ciphertext of msg_len bytes (tag excluded)."""
+        return CCMStream(self, msg_len, associated_data, decrypt=True)
+
+
+# ==============================================================================
+#  Streaming CMAC / CCM
+#  Incremental update()/finalize() objects that keep only the 16-byte chaining
+#  state plus at most one partial block, so fragmented payloads can be
+#  authenticated and decrypted as they arrive.
+# ==============================================================================
+
+class CMACStream:
+    """Incremental CMAC. Create with CMAC.stream()."""
+
+    def __init__(self, cmac: CMAC):
+        self._encrypt = cmac.cipher.encrypt_block
+        self._bs = cmac.block_size
+        self._k1 = int.from_bytes(cmac.k1, 'big')
+        self._k2 = int.from_bytes(cmac.k2, 'big')
+        self._x = 0
+        # The last block is only known at finalize(), so a full block is held
+        # back until more data arrives.
+        self._pending = bytearray(self._bs)
+        self._pending_len = 0
+        self._done = False
+
+    def _absorb(self, block):
+        x = self._x ^ int.from_bytes(block, 'big')
+        self._x = int.from_bytes(self._encrypt(x.to_bytes(self._bs, 'big')), 'big')
+
+    def update(self, chunk: bytes):
+        if self._done:
+            raise ValueError("update() called after finalize().")
+        bs = self._bs
+        data = memoryview(chunk)
+        n = len(data)
+        i = 0
+        if self._pending_len:
+            take = min(bs - self._pending_len, n)
+            self._pending[self._pending_len:self._pending_len + take] = data[:take]
+            self._pending_len += take
+            i = take
+            if self._pending_len == bs and i < n:
+                self._absorb(self._pending)
+                self._pending_len = 0
+        while n - i > bs:
+            self._absorb(data[i:i + bs])
+            i += bs
+        if i < n:
+            self._pending[self._pending_len:self._pending_len + n - i] = data[i:]
+            self._pending_len += n - i
+
+    def finalize(self) -> bytes:
+        """Returns the tag. The object cannot be updated afterwards."""
+        if self._done:
+            raise ValueError("finalize() called twice.")
+        self._done = True
+        bs = self._bs
+        last = int.from_bytes(self._pending[:self._pending_len], 'big')
+        if self._pending_len == bs:
+            last ^= self._k1
+        else:
+            # 10* padding, then K2
+            last = ((last << 8 | 0x80) << (8 * (bs - self._pending_len - 1))) ^ self._k2
+        x = self._x ^ last
+        return self._encrypt(x.to_bytes(bs, 'big'))
+
+
+class CCMStream:
+    """
+    Incremental CCM encryption or decryption. Create with CCM.encryptor() or
+    CCM.decryptor().
+
+    CCM puts the message length into B0, so it has to be declared up front;
+    the associated data is also given at creation. update() returns the
+    output for each chunk immediately. For decryption that output is
+    unauthenticated until finalize(tag) returns True.
+    """
+
+    def __init__(self, ccm: "CCM", msg_len: int, associated_data: bytes = b"", decrypt: bool = False):
+        if msg_len > 2**(ccm.L * 8):
+            raise ValueError("Message is too long.")
+        self._encrypt = ccm.cipher.encrypt_block
+        self._bs = bs = ccm.block_size
+        self._mac_len = ccm.mac_len
+        self._decrypt = decrypt
+        self._msg_len = msg_len
+        self._seen = 0
+        self._done = False
+
+        # Counter block template A_i = flags | nonce | i
+        self._a_prefix = bytes([ccm.L - 1]) + ccm.nonce
+        self._L = ccm.L
+        self._s0 = int.from_bytes(self._encrypt(self._counter_block(0)), 'big')
+        self._ctr_index = 0
+        self._ks = b""
+        self._ks_pos = 0
+
+        # CBC-MAC over B0 and the formatted associated data
+        self._x = 0
+        self._pending = bytearray(bs)
+        self._pending_len = 0
+        header = ccm._format_b0(associated_data, msg_len)
+        if associated_data:
+            header += ccm._format_auth_data(associated_data, b"")
+        for i in range(0, len(header), bs):
+            self._mac_block(header[i:i + bs])
+
+    def _counter_block(self, i: int) -> bytes:
+        return self._a_prefix + i.to_bytes(self._L, 'big')
+
+    def _mac_block(self, block):
+        x = self._x ^ int.from_bytes(block, 'big')
+        self._x = int.from_bytes(self._encrypt(x.to_bytes(self._bs, 'big')), 'big')
+
+    def _mac_update(self, data):
+        bs = self._bs
+        n = len(data)
+        i = 0
+        if self._pending_len:
+            take = min(bs - self._pending_len, n)
+            self._pending[self._pending_len:self._pending_len + take] = data[:take]
+            self._pending_len += take
+            i = take
+            if self._pending_len < bs:
+                return
+            self._mac_block(self._pending)
+            self._pending_len = 0
+        while n - i >= bs:
+            self._mac_block(data[i:i + bs])
+            i += bs
+        if i < n:
+            self._pending[:n - i] = data[i:]
+            self._pending_len = n - i
+
+    def _keystream(self, n: int) -> bytes:
+        """Takes the next n keystream bytes from S_1, S_2, ..."""
+        out = self._ks[self._ks_pos:self._ks_pos + n]
+        self._ks_pos += len(out)
+        while len(out) < n:
+            self._ctr_index += 1
+            self._ks = self._encrypt(self._counter_block(self._ctr_index))
+            take = min(self._bs, n - len(out))
+            out += self._ks[:take]
+            self._ks_pos = take
+        return out
+
+    def update(self, chunk: bytes) -> bytes:
+        """Encrypts or decrypts the next chunk and returns the result."""
+        if self._done:
+            raise ValueError("update() called after finalize().")
+        n = len(chunk)
+        if self._seen + n > self._msg_len:
+            raise ValueError("More data than the declared message length.")
+        self._seen += n
+        if n == 0:
+            return b""
+        ks = self._keystream(n)
+        out = (int.from_bytes(chunk, 'big') ^ int.from_bytes(ks, 'big')).to_bytes(n, 'big')
+        # CBC-MAC always runs over the plaintext
+        self._mac_update(out if self._decrypt else memoryview(chunk))
+        return out
+
+    def _final_tag(self) -> bytes:
+        if self._done:
+            raise ValueError("finalize() called twice.")
+        self._done = True
+        if self._seen != self._msg_len:
+            raise ValueError("Less data than the declared message length.")
+        if self._pending_len:
+            self._pending[self._pending_len:] = bytes(self._bs - self._pending_len)
+            self._mac_block(self._pending)
+        return (self._x ^ self._s0).to_bytes(self._bs, 'big')[:self._mac_len]
+
+    def finalize(self, tag: bytes = None):
+        """
+        Encryptor: returns the tag.
+        Decryptor: checks the received tag and returns True if it matches.
+        """
+        expected_tag = self._final_tag()
+        if not self._decrypt:
+            return expected_tag
+        if tag is None or len(tag) != self._mac_len:
+            raise ValueError("Invalid tag length")
+        # Constant-time comparison
+        result = 0
+        for x_byte, y_byte in zip(expected_tag, tag):
+            result |= x_byte ^ y_byte
+        return result == 0
+
+# ==============================================================================
+#  Session-scoped CCM (Sesame packet format)
+# ==============================================================================
+
+class CCMSession:
+    """
+    Long-lived CCM context for one Sesame login session.
+
+    The Sesame nonce is the 9-byte little-endian packet counter followed by
+    the 4-byte random_code pushed by the lock, so everything except the
+    counter is fixed for the session. The key schedule, the B0/A0 templates
+    and the formatted associated-data block are prepared once here, and
+    seal()/open() only fill in the counter and run the block encryptions.
+
+    Because the counters are predictable, the keystream of upcoming packets
+    can be computed ahead with prefill() while the link is idle; it is kept
+    until discard_before() passes it or retain() leaves it out.
+    """
+    L = 2
+    COUNTER_LEN = 9
+
+    def __init__(self, key: bytes, random_code: bytes, mac_len: int = 4,
+                 associated_data: bytes = b"\x00", cipher_class=TTableAES):
+        if not (4 <= mac_len <= 16 and mac_len % 2 == 0):
+            raise ValueError("MAC length must be an even integer between 4 and 16.")
+        if len(random_code) != 15 - self.L - self.COUNTER_LEN:
+            raise ValueError(f"random_code must be {15 - self.L - self.COUNTER_LEN} bytes.")
+        if len(associated_data) >= (2**16 - 2**8):
+            raise ValueError("Associated data is too long.")
+
+        self.cipher = cipher_class(key)
+        self.block_size = self.cipher.BLOCK_SIZE
+        self.mac_len = mac_len
+        self.random_code = bytes(random_code)
+        self.associated_data = bytes(associated_data)
+        # counter -> S_0 || S_1 || ... filled ahead of time by prefill()
+        self._keystream_cache = {}
+
+        # B0 = flags | counter | random_code | mlen
+        adata_flag = 1 if len(associated_data) > 0 else 0
+        b0_flags = (adata_flag << 6) | (((mac_len - 2) // 2) << 3) | (self.L - 1)
+        self._b0_template = bytes([b0_flags]) + bytes(self.COUNTER_LEN) + self.random_code + bytes(self.L)
+
+        # A_i = flags | counter | random_code | i
+        self._a_template = bytes([self.L - 1]) + bytes(self.COUNTER_LEN) + self.random_code + bytes(self.L)
+
+        # Formatted associated data blocks (B1, ...) never change within a session
+        auth = bytearray()
+        if adata_flag:
+            auth.extend(len(associated_data).to_bytes(2, 'big'))
+            auth.extend(associated_data)
+            padding_len = -len(auth) % self.block_size
+            auth.extend(bytes(padding_len))
+        self._adata_blocks = tuple(
+            int.from_bytes(auth[i:i + self.block_size], 'big')
+            for i in range(0, len(auth), self.block_size)
+        )
+
+        # Scratch buffers for seal_into()/open_into(): allocated once per session
+        self._adata_block_bytes = tuple(
+            bytes(auth[i:i + self.block_size]) for i in range(0, len(auth), self.block_size)
+        )
+        self._b0_buf = bytearray(self._b0_template)
+        self._a_buf = bytearray(self._a_template)
+        self._mac_buf = bytearray(self.block_size)
+        self._ks_buf = bytearray(self.block_size)
+        encrypt_into = getattr(self.cipher, "encrypt_into", None)
+        if encrypt_into is None:
+            encrypt_block = self.cipher.encrypt_block
+
+            def encrypt_into(src, dst):
+                dst[:] = encrypt_block(bytes(src))
+        self._encrypt_into = encrypt_into
+
+    def _block(self, template: bytes, counter: int, tail: int) -> bytes:
+        """Fills the counter and the trailing L-byte field into a template."""
+        block = bytearray(template)
+        block[1:1 + self.COUNTER_LEN] = counter.to_bytes(self.COUNTER_LEN, 'little')
+        block[-self.L:] = tail.to_bytes(self.L, 'big')
+        return bytes(block)
+
+    def _cbc_mac(self, counter: int, message: bytes) -> int:
+        """CBC-MAC over B0, the session's adata blocks and the message."""
+        encrypt = self.cipher.encrypt_block
+        bs = self.block_size
+        x = int.from_bytes(encrypt(self._block(self._b0_template, counter, len(message))), 'big')
+        for a in self._adata_blocks:
+            x = int.from_bytes(encrypt((x ^ a).to_bytes(bs, 'big')), 'big')
+        for i in range(0, len(message), bs):
+            chunk = message[i:i + bs]
+            m = int.from_bytes(chunk, 'big') << (8 * (bs - len(chunk)))
+            x = int.from_bytes(encrypt((x ^ m).to_bytes(bs, 'big')), 'big')
+        return x
+
+    def _keystream(self, counter: int, length: int) -> bytes:
+        """
+        Returns S_0 || S_1 || ... covering `length` payload bytes for this
+        counter, taking the blocks already computed by prefill() from the cache.
+        """
+        bs = self.block_size
+        need = 1 + math.ceil(length / bs)
+        ks = self._keystream_cache.get(counter, b"")
+        have = len(ks) // bs
+        if have < need:
+            encrypt = self.cipher.encrypt_block
+            ks += b"".join(encrypt(self._block(self._a_template, counter, i)) for i in range(have, need))
+            if counter in self._keystream_cache:
+                self._keystream_cache[counter] = ks
+        return ks
+
+    def prefill(self, counter: int, num_blocks: int = 2) -> bool:
+        """
+        Precomputes S_0..S_num_blocks for a future counter so that sealing or
+        opening that packet only costs the CBC-MAC and an XOR.
+        Returns True if any block had to be computed.
+        """
+        cached = len(self._keystream_cache.get(counter, b"")) // self.block_size
+        if cached > num_blocks:
+            return False
+        self._keystream_cache[counter] = self._keystream_cache.get(counter, b"")
+        self._keystream(counter, num_blocks * self.block_size)
+        return True
+
+    def discard_before(self, counter: int):
+        """Drops cached keystream for counters that have already been used."""
+        for c in [c for c in self._keystream_cache if c < counter]:
+            del self._keystream_cache[c]
+
+    def retain(self, *windows):
+        """
+        Drops cached keystream for every counter outside the given
+        (start, stop) windows, e.g. the upcoming tx and rx counters, so the
+        cache never holds more than the windows cover.
+        """
+        for c in [c for c in self._keystream_cache
+                  if not any(start <= c < stop for start, stop in windows)]:
+            del self._keystream_cache[c]
+
+    def cached_counters(self) -> list[int]:
+        """Counters whose keystream is currently cached."""
+        return sorted(self._keystream_cache)
+
+    def _ctr_xor(self, keystream: bytes, data: bytes) -> bytes:
+        """XORs data with S_1, S_2, ... taken from the keystream."""
+        n = len(data)
+        if n == 0:
+            return b""
+        s = keystream[self.block_size:self.block_size + n]
+        return (int.from_bytes(data, 'big') ^ int.from_bytes(s, 'big')).to_bytes(n, 'big')
+
+    def _tag(self, keystream: bytes, counter: int, plaintext: bytes) -> bytes:
+        t = self._cbc_mac(counter, plaintext) ^ int.from_bytes(keystream[:self.block_size], 'big')
+        return t.to_bytes(self.block_size, 'big')[:self.mac_len]
+
+    def seal(self, counter: int, plaintext: bytes) -> bytes:
+        """Encrypts one packet. Returns ciphertext || tag."""
+        if len(plaintext) >= 2**(self.L * 8):
+            raise ValueError("Plaintext is too long.")
+        keystream = self._keystream(counter, len(plaintext))
+        return self._ctr_xor(keystream, plaintext) + self._tag(keystream, counter, plaintext)
+
+    # --- In-place path: constant heap footprint per session -----------------
+    # Use with cipher_class=InPlaceAES (or any cipher with encrypt_into) to
+    # avoid all per-packet allocations; other ciphers fall back to
+    # encrypt_block() and still work, but allocate the block they return.
+
+    def _set_counter(self, buf, counter: int, tail: int):
+        for i in range(self.COUNTER_LEN):
+            buf[1 + i] = (counter >> (8 * i)) & 0xFF
+        buf[14] = (tail >> 8) & 0xFF
+        buf[15] = tail & 0xFF
+
+    def _mac_into(self, counter: int, msg, offset: int, n: int):
+        """CBC-MAC of msg[offset:offset + n] into the session's mac buffer."""
+        enc = self._encrypt_into
+        x = self._mac_buf
+        bs = self.block_size
+        self._set_counter(self._b0_buf, counter, n)
+        enc(self._b0_buf, x)
+        for block in self._adata_block_bytes:
+            xor_into(x, x, block, bs)
+            enc(x, x)
+        for i in range(0, n, bs):
+            # XOR of a short block leaves the zero-padded tail unchanged
+            for j in range(min(bs, n - i)):
+                x[j] ^= msg[offset + i + j]
+            enc(x, x)
+
+    def _ctr_into(self, counter: int, src, src_offset: int, dst, dst_offset: int, n: int):
+        enc = self._encrypt_into
+        a = self._a_buf
+        ks = self._ks_buf
+        bs = self.block_size
+        for i in range(0, n, bs):
+            self._set_counter(a, counter, i // bs + 1)
+            enc(a, ks)
+            for j in range(min(bs, n - i)):
+                dst[dst_offset + i + j] = src[src_offset + i + j] ^ ks[j]
+
+    def _s0_into(self, counter: int):
+        self._set_counter(self._a_buf, counter, 0)
+        self._encrypt_into(self._a_buf, self._ks_buf)
+
+    def seal_into(self, counter: int, plaintext, out) -> int:
+        """
+        Writes ciphertext || tag for plaintext into out (a bytearray or
+        memoryview of at least len(plaintext) + mac_len bytes).
+        Returns the number of bytes written.
+        """
+        n = len(plaintext)
+        if len(out) < n + self.mac_len:
+            raise ValueError("Output buffer is too small.")
+        self._mac_into(counter, plaintext, 0, n)
+        self._ctr_into(counter, plaintext, 0, out, 0, n)
+        self._s0_into(counter)
+        x = self._mac_buf
+        ks = self._ks_buf
+        for j in range(self.mac_len):
+            out[n + j] = x[j] ^ ks[j]
+        return n + self.mac_len
+
+    def open_into(self, counter: int, packet, out) -> int:
+        """
+        Decrypts packet (ciphertext || tag) into out. Returns the plaintext
+        length, or -1 if the tag does not verify (out is then zeroed).
+        """
+        n = len(packet) - self.mac_len
+        if n < 0:
+            raise ValueError("Packet is shorter than the tag.")
+        if len(out) < n:
+            raise ValueError("Output buffer is too small.")
+        self._ctr_into(counter, packet, 0, out, 0, n)
+        self._mac_into(counter, out, 0, n)
+        self._s0_into(counter)
+
+        # Constant-time comparison
+        ks = self._ks_buf
+        xor_into(ks, self._mac_buf, ks, self.mac_len)
+        result = 0
+        for j in range(self.mac_len):
+            result |= ks[j] ^ packet[n + j]
+        if result != 0:
+            for j in range(n):
+                out[j] = 0
+            return -1
+        return n
+
+    def open(self, counter: int, data: bytes) -> bytes | None:
+        """
+        Decrypts one packet (ciphertext || tag).
+        Returns the plaintext if the tag verifies, otherwise None.
+        """
+        if len(data) < self.mac_len:
+            raise ValueError("Packet is shorter than the tag.")
+        keystream = self._keystream(counter, len(data) - self.mac_len)
+        plaintext = self._ctr_xor(keystream, data[:-self.mac_len])
+        expected_tag = self._tag(keystream, counter, plaintext)
+
+        # Constant-time comparison
+        result = 0
+        for x_byte, y_byte in zip(expected_tag, data[-self.mac_len:]):
+            result |= x_byte ^ y_byte
+        return plaintext if result == 0 else None
+
 
 # ==============================================================================
 #  示例和测试
@@ -487,3 +1309,22 @@ if __name__ == '__main__':
     print(f"decrypted text: {decrypted_text.hex()}")
     print(f"decrypted text: 070200e4505d68")
 
+
+    # T-table engine must produce exactly the same output as the reference AES
+    print("-" * 20+"\n"*2)
+    print(f"##################   04 T-table engine   ########################")
+    token_tt = CMAC(device_secret, cipher_class=TTableAES).generate(random_code)
+    ccm_tt = CCM(key=key_ccm, nonce=nonce, mac_len=4, cipher_class=TTableAES)
+    ciphertext_tt, tag_tt = ccm_tt.encrypt(plaintext=plaintext, associated_data=bytes([0]))
+    print(f"token:      {token_tt.hex()} (match: {token_tt == token})")
+    print(f"Ciphertext: {ciphertext_tt.hex()} (match: {ciphertext_tt.hex() == '0fe85988a1'})")
+    print(f"Tag:        {tag_tt.hex()} (match: {tag_tt == tag_enc})")
+
+    # Session context: one object per login, one call per packet
+    print("-" * 20+"\n"*2)
+    print(f"##################   05 Session   ########################")
+    session = CCMSession(key_ccm, random_code, mac_len=4)
+    sealed = session.seal(0, b"\x53\x03abc")
+    opened = session.open(0, bytes.fromhex("5be9380e92ef281570a55b"))
+    print(f"sealed: {sealed.hex()} (match: {sealed.hex() == '0fe85988a1c8568b6b'})")
+    print(f"opened: {opened.hex()} (match: {opened.hex() == '070200e4505d68'})")
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmarks for the Sesame crypto hot paths.
+
+Covers AES.encrypt_block / AES._expand_key for every engine in AES_CCM,
+CMAC.generate, CCM.encrypt / CCM.decrypt at Sesame packet sizes and at bulk
+sizes, the sesame_crypto backends, and the SesameController encode/decode
+round trip. Every case is first checked against the known vectors from
+AES_CCM's __main__ block (sesame_crypto.KNOWN_VECTORS), which are also used
+as the benchmark inputs.
+
+For each case it reports ops/s, ns/op and allocations per op, where
+allocations are the peak bytes traced by tracemalloc while one op runs.
+
+Usage:
+    python bench_crypto.py                   # run and compare with the baseline
+    python bench_crypto.py --save            # run and store a new baseline
+    python bench_crypto.py --threshold 10    # fail on >10% regressions
+    python bench_crypto.py -k CCM            # only cases whose name contains "CCM"
+
+Exits with status 1 when a metric regresses by more than the threshold, or
+when the baseline file or a case's baseline entry is missing.
+
+Absolute timings depend on the machine, so the gate compares each case's
+ns/op as a ratio to REFERENCE_CASE measured in the same run (the reference
+case always runs, even when -k filters it out). The baseline also records
+the interpreter and machine it was made on; allocations are only compared
+when the Python version matches, since they depend on the interpreter.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import AES_CCM
+import sesame_crypto
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+DEFAULT_THRESHOLD = 15.0  # percent
+REFERENCE_CASE = "AES.encrypt_block"  # pure Python, available everywhere
+
+# Sesame commands and notifications are 5-20 bytes; bulk sizes cover history
+# downloads and offline log decryption.
+PACKET_SIZES = (5, 13, 20)
+BULK_SIZES = (256, 1024)
+
+ENGINES = [("AES", AES_CCM.AES), ("TTableAES", AES_CCM.TTableAES), ("InPlaceAES", AES_CCM.InPlaceAES)]
+if AES_CCM.np is not None:
+    ENGINES.append(("NumpyAES", AES_CCM.NumpyAES))
+
+V = sesame_crypto.KNOWN_VECTORS
+
+
+def _payload(size: int) -> bytes:
+    """Repeats the known Sesame command plaintext up to `size` bytes."""
+    seed = V["seal"][1]
+    return (seed * (size // len(seed) + 1))[:size]
+
+
+def _nonce(counter: int = 0) -> bytes:
+    return sesame_crypto.make_nonce(counter, V["random_code"])
+
+
+# ==============================================================================
+#  Correctness checks (known vectors)
+# ==============================================================================
+
+def check_vectors():
+    """Verifies every engine and backend against the known vectors before timing."""
+    counter, plaintext, packet = V["seal"]
+    for name, engine in ENGINES:
+        token = AES_CCM.CMAC(V["device_secret"], cipher_class=engine).generate(V["random_code"])
+        assert token == V["token"], f"{name}: CMAC token mismatch"
+        ccm = AES_CCM.CCM(token, _nonce(counter), mac_len=4, cipher_class=engine)
+        ciphertext, tag = ccm.encrypt(plaintext, associated_data=sesame_crypto.AAD)
+        assert ciphertext + tag == packet, f"{name}: CCM encrypt mismatch"
+        counter_o, plaintext_o, packet_o = V["open"]
+        ccm = AES_CCM.CCM(token, _nonce(counter_o), mac_len=4, cipher_class=engine)
+        decrypted = ccm.decrypt(packet_o[:-4], packet_o[-4:], associated_data=sesame_crypto.AAD)
+        assert decrypted == plaintext_o, f"{name}: CCM decrypt mismatch"
+    for name in sesame_crypto.available_backends():
+        assert sesame_crypto.self_test(sesame_crypto.get_backend(name)), f"{name}: backend self-test failed"
+
+
+# ==============================================================================
+#  Benchmark cases
+# ==============================================================================
+
+def build_cases():
+    """Returns a list of (name, fn) where fn() runs one op."""
+    cases = []
+    token = V["token"]
+    block = V["seal"][2][:16].ljust(16, b"\x00")
+
+    for name, engine in ENGINES:
+        cipher = engine(token)
+        cases.append((f"{name}.encrypt_block", lambda c=cipher: c.encrypt_block(block)))
+        cases.append((f"{name}._expand_key", lambda c=cipher: c._expand_key(token)))
+
+        cmac = AES_CCM.CMAC(V["device_secret"], cipher_class=engine)
+        cases.append((f"{name}/CMAC.generate[4]", lambda m=cmac: m.generate(V["random_code"])))
+
+        for size in PACKET_SIZES + BULK_SIZES:
+            pt = _payload(size)
+            ccm = AES_CCM.CCM(token, _nonce(), mac_len=4, cipher_class=engine)
+            ct, tag = ccm.encrypt(pt, associated_data=sesame_crypto.AAD)
+            cases.append((f"{name}/CCM.encrypt[{size}]",
+                          lambda c=ccm, p=pt: c.encrypt(p, associated_data=sesame_crypto.AAD)))
+            cases.append((f"{name}/CCM.decrypt[{size}]",
+                          lambda c=ccm, x=ct, t=tag: c.decrypt(x, t, associated_data=sesame_crypto.AAD)))
+
+    # Allocation-free session path
+    in_place = AES_CCM.CCMSession(token, V["random_code"], mac_len=4, cipher_class=AES_CCM.InPlaceAES)
+    out = bytearray(64)
+    for size in PACKET_SIZES:
+        pt = _payload(size)
+        packet = in_place.seal(0, pt)
+        cases.append((f"InPlaceAES/CCMSession.seal_into[{size}]",
+                      lambda p=pt: in_place.seal_into(0, p, out)))
+        cases.append((f"InPlaceAES/CCMSession.open_into[{size}]",
+                      lambda p=packet: in_place.open_into(0, p, out)))
+
+    if AES_CCM.np is not None:
+        engine = AES_CCM.NumpyAES(token)
+        blocks = AES_CCM.np.zeros((1024, 16), dtype=AES_CCM.np.uint8)
+        cases.append(("NumpyAES.encrypt_blocks[1024]", lambda: engine.encrypt_blocks(blocks)))
+        keys = [V["device_secret"]] * 1024
+        codes = [V["random_code"]] * 1024
+        cases.append(("CMAC.generate_tokens[1024]", lambda: AES_CCM.CMAC.generate_tokens(keys, codes)))
+
+    for backend_name in sesame_crypto.available_backends():
+        backend = sesame_crypto.get_backend(backend_name)
+        cases.append((f"backend:{backend_name}/login_token",
+                      lambda b=backend: b.login_token(V["device_secret"], V["random_code"])))
+        session = backend.new_session(token, V["random_code"])
+        for size in PACKET_SIZES:
+            pt = _payload(size)
+            packet = session.seal(0, pt)
+            cases.append((f"backend:{backend_name}/seal[{size}]", lambda s=session, p=pt: s.seal(0, p)))
+            cases.append((f"backend:{backend_name}/open[{size}]", lambda s=session, p=packet: s.open(0, p)))
+
+    cases.extend(_controller_cases())
+    return cases
+
+
+def _controller_cases():
+    """SesameController.encode/decode round trip for every backend (needs bleak)."""
+    try:
+        from s5WinApp import SesameController
+    except ImportError as e:
+        print(f"skipping SesameController cases: {e}")
+        return []
+
+    def make_round_trip(backend_name):
+        # Built on first call, so cases filtered out by -k never create a
+        # controller; the controller's INFO logging is muted while it logs in.
+        controller = None
+        pt = V["seal"][1]
+
+        def round_trip():
+            nonlocal controller
+            if controller is None:
+                previous = logging.root.manager.disable
+                logging.disable(logging.INFO)
+                try:
+                    sesame_crypto.use_backend(backend_name)
+                    controller = SesameController("00:00:00:00:00:00", V["device_secret"].hex())
+                    controller.protocol.random_code = V["random_code"]
+                    controller.generate_session_key()
+                finally:
+                    sesame_crypto.use_backend(sesame_crypto.available_backends()[0])
+                    logging.disable(previous)
+            if controller.decode(controller.encode(pt)) != pt:
+                raise AssertionError("encode/decode round trip failed")
+
+        return round_trip
+
+    return [(f"SesameController[{name}].encode+decode", make_round_trip(name))
+            for name in sesame_crypto.available_backends()]
+
+
+# ==============================================================================
+#  Measurement
+# ==============================================================================
+
+def measure(fn, min_time: float = 0.2, repeats: int = 3) -> dict:
+    """Times fn() and traces its allocations. Returns the metrics for one case."""
+    fn()  # warm-up
+
+    # Calibrate the loop count so one repeat takes at least min_time
+    loops = 1
+    while True:
+        start = time.perf_counter_ns()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter_ns() - start
+        if elapsed >= min_time * 1e9 or loops >= 1 << 20:
+            break
+        loops *= 2 if elapsed == 0 else max(2, min(10, int(min_time * 1e9 / elapsed) + 1))
+
+    best = elapsed
+    for _ in range(repeats - 1):
+        start = time.perf_counter_ns()
+        for _ in range(loops):
+            fn()
+        best = min(best, time.perf_counter_ns() - start)
+    ns_per_op = best / loops
+
+    tracemalloc.start()
+    try:
+        samples = min(loops, 16)
+        peak = 0
+        for _ in range(samples):
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            fn()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "ops_per_s": 1e9 / ns_per_op,
+        "ns_per_op": ns_per_op,
+        "alloc_bytes_per_op": peak,
+    }
+
+
+def environment() -> dict:
+    """Describes the interpreter and machine a baseline was recorded on."""
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "reference": REFERENCE_CASE,
+    }
+
+
+def relative(results: dict) -> dict:
+    """Adds each case's ns/op as a ratio to REFERENCE_CASE from the same run."""
+    ref = results[REFERENCE_CASE]["ns_per_op"]
+    return {name: dict(m, relative=m["ns_per_op"] / ref) for name, m in results.items()}
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """
+    Returns one message per metric that regressed by more than threshold
+    percent, and one per case that has no baseline entry. results must come
+    from relative(); baseline is the stored {"environment", "cases"} dict.
+    """
+    same_python = baseline["environment"]["python"].rsplit(".", 1)[0] == \
+        platform.python_version().rsplit(".", 1)[0]
+    metrics_checked = ("relative", "alloc_bytes_per_op") if same_python else ("relative",)
+    regressions = []
+    for name, metrics in results.items():
+        base = baseline["cases"].get(name)
+        if not base:
+            regressions.append(f"{name}: no baseline entry; run with --save")
+            continue
+        for metric in metrics_checked:
+            if base[metric] <= 0:
+                continue
+            change = (metrics[metric] - base[metric]) / base[metric] * 100
+            if change > threshold:
+                regressions.append(f"{name}: {metric} regressed by {change:.1f}%")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Sesame crypto micro-benchmarks")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline JSON file")
+    parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed regression in percent (default: %(default)s)")
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds per timing repeat")
+    parser.add_argument("-k", dest="filter", default="", help="only run cases whose name contains this")
+    args = parser.parse_args(argv)
+
+    check_vectors()
+
+    results = {}
+    print(f"{'case':<52} {'ops/s':>12} {'ns/op':>14} {'alloc B/op':>11}")
+    print("-" * 92)
+    for name, fn in build_cases():
+        if args.filter not in name and name != REFERENCE_CASE:
+            continue
+        m = measure(fn, min_time=args.min_time)
+        results[name] = m
+        print(f"{name:<52} {m['ops_per_s']:>12.1f} {m['ns_per_op']:>14.1f} {m['alloc_bytes_per_op']:>11}")
+    results = relative(results)
+
+    if args.save:
+        cases = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                cases = json.load(f)["cases"]
+        cases.update({name: {k: m[k] for k in ("ns_per_op", "relative", "alloc_bytes_per_op")}
+                      for name, m in results.items()})
+        with open(args.baseline, "w") as f:
+            json.dump({"environment": environment(), "cases": cases}, f, indent=2, sort_keys=True)
+        print(f"\nBaseline saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"\nNo baseline at {args.baseline}; run with --save to create one.")
+        return 1
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    env = baseline["environment"]
+    print(f"\nBaseline recorded on {env['implementation']} {env['python']}, {env['platform']}; "
+          f"ns/op compared as ratios to {env['reference']}.")
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"\n{len(regressions)} regression(s) over {args.threshold}%:")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    print(f"\nNo regressions over {args.threshold}% against {args.baseline}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
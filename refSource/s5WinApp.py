@@ -1,37 +1,193 @@
 import asyncio
+import os
+import sys
 import time
+from collections import deque
 from bleak import BleakClient, BleakError
-from Crypto.Cipher import AES
-from Crypto.Hash import CMAC
 import logging
 
+# sesame_crypto 与 ESP32 固件共用，放在 src/ 下
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import sesame_crypto
+import sesame_protocol
+from sesame_protocol import (
+    MechStatus, CMD_CHARACTERISTIC_UUID, STATUS_CHARACTERISTIC_UUID,
+    MSG_TYPE_AUTH_FAILED, MSG_TYPE_RESPONSE, MSG_TYPE_PUBLISH,
+    ITEM_CODE_LOGIN, ITEM_CODE_HISTORY, ITEM_CODE_VERSION, ITEM_CODE_RANDOM_CODE,
+    ITEM_CODE_SETTING, ITEM_CODE_MECH_STATUS, ITEM_CODE_LOCK, ITEM_CODE_UNLOCK, RESULT_NOT_FOUND,
+)
+from sesame_history import HistoryRecord
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # --- 常量定义 ---
 CONNECTION_TIMEOUT = 20.0
-CMD_CHARACTERISTIC_UUID = "16860002-a5ae-9856-b6d3-dbb4c676993e"
-STATUS_CHARACTERISTIC_UUID = "16860003-a5ae-9856-b6d3-dbb4c676993e"
-ITEM_CODE_LOGIN = 2
-ITEM_CODE_LOCK = 82
-ITEM_CODE_UNLOCK = 83
+RANDOM_CODE_TIMEOUT = 10.0  # 连接后等待锁推送 random code 的时间
+LOGIN_TIMEOUT = 5.0         # 发送登录指令后等待锁应答 (7/2) 的时间
+COMMAND_TIMEOUT = 10.0      # 加密指令发出后等待锁应答 (7/item code) 的时间
+HISTORY_READ = b'\x01'      # 历史请求参数：读取最早一条记录
+HISTORY_WINDOW = 4          # 下载历史时同时在途的请求数
+# 后台预计算密钥流：当前计数器之后的包数，以及每个包预算的 CTR 块数（S_1..S_k）
+KEYSTREAM_WINDOW = 8
+KEYSTREAM_BLOCKS = 2
+
 
+class SesameCommandError(Exception):
+    """锁对指令的应答结果码不为 0"""
+
+    def __init__(self, item_code, result):
+        super().__init__(f"item code {item_code} 返回结果码 {result}")
+        self.item_code = item_code
+        self.result = result
 
 
 class SesameController:
-    def __init__(self, mac_address, device_secret_hex):
+    """
+    SesameProtocol 在 bleak 上的适配器：负责连接、通知回调、写特性，
+    以及把应答和指令的 Future 对应起来。协议本身（分片、计数器、登录、CCM）在 sesame_protocol 中。
+    """
+
+    def __init__(self, mac_address, device_secret_hex, client_factory=BleakClient):
         self.mac_address = mac_address
         self.device_secret = bytes.fromhex(device_secret_hex)
+        # 与 BleakClient(address, timeout=, disconnected_callback=) 同签名，sesame_sim 用它注入内存链路
+        self.client_factory = client_factory
         self.client = None
-        self.random_code = None
-        self.session_key = None
-        self.tx_counter = 0
-        self.rx_counter = 0
+        # 传入模块本身，use_backend() 切换后端后立即生效
+        self.protocol = sesame_protocol.SesameProtocol(self.device_secret, crypto=sesame_crypto)
+        self.last_status = None  # 最近一次机械状态推送 (item code 81)，MechStatus
+        self._last_status_raw = None
+        self.status_listeners = []  # 状态变化时调用 listener(mac_address, MechStatus)
+        self.status_received_event = asyncio.Event()  # 收到第一次机械状态推送后置位
         self.random_code_received_event = asyncio.Event()
+        self._login_acked = asyncio.Event()
+        self._session_lock = asyncio.Lock()
+        self._write_lock = asyncio.Lock()
+        self._pending = {}  # item code -> 按发送（计数器）顺序排列的等待应答的 Future
+        # (消息类型, item code) -> 处理函数；item code 为 None 的项匹配该类型的其余消息
+        self._dispatch = {
+            (MSG_TYPE_AUTH_FAILED, None): self._on_auth_failed,
+            (MSG_TYPE_RESPONSE, None): self._on_response,
+            (MSG_TYPE_PUBLISH, ITEM_CODE_RANDOM_CODE): self._on_random_code,
+            (MSG_TYPE_PUBLISH, ITEM_CODE_SETTING): self._on_setting,
+            (MSG_TYPE_PUBLISH, ITEM_CODE_MECH_STATUS): self._on_mech_status,
+        }
+        self._relogin_task = None
+        self._disconnecting = False
+        self._drop_task = None  # 通知回调/超时回调里发起的断开，ensure_session() 会先等它完成
+        self._keystream_task = None
+        self._keystream_wanted = asyncio.Event()
+
+    # --- 协议状态（只读，由 self.protocol 维护）---
+    @property
+    def random_code(self):
+        return self.protocol.random_code
+
+    @property
+    def session_key(self):
+        return self.protocol.session_key
+
+    @property
+    def session(self):
+        return self.protocol.session
+
+    @property
+    def tx_counter(self):
+        return self.protocol.tx_counter
+
+    @property
+    def rx_counter(self):
+        return self.protocol.rx_counter
+
+    @property
+    def is_logged_in(self):
+        """链路仍连接，且当前 random code 对应的会话已被锁确认"""
+        return (self.client is not None and self.client.is_connected
+                and self.session is not None and self._login_acked.is_set())
+
+    def _reset_session(self):
+        """作废当前会话：新的 random code 或重新连接后，计数器从 0 开始"""
+        self._stop_keystream_filler()
+        self.protocol.end_session()
+        self._login_acked.clear()
+        self._fail_pending(ConnectionError(f"{self.mac_address} 的会话已失效"))
+
+    def _expect(self, item_code, timeout):
+        """登记一个等待 (7, item_code) 应答的 Future，超时后以 TimeoutError 结束"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.setdefault(item_code, deque()).append(future)
+        handle = loop.call_later(timeout, self._expire, future, item_code)
+        future.add_done_callback(lambda f: handle.cancel())
+        return future
+
+    def _expire(self, future, item_code):
+        """
+        应答超时。锁按计数器顺序应答，丢了一个应答之后无法再确定后面的应答对应哪条指令，
+        所以作废会话（其余等待中的 Future 以 ConnectionError 结束）并断开，下一条指令重新登录。
+        """
+        if future.done():
+            return
+        future.set_exception(asyncio.TimeoutError(f"等待 item code {item_code} 的应答超时"))
+        logging.warning(f"{self.mac_address} 的 item code {item_code} 应答超时，应答对应关系已丢失，断开重连。")
+        self._reset_session()
+        self._drop_link_soon()
+
+    def _resolve(self, item_code, result, payload):
+        """
+        锁按计数器顺序应答，同一 item code 的应答对应最早发出的那条指令。
+        被调用方取消的 Future（例如提前结束的 iter_history）仍留在队列里占位，
+        它的应答在这里被丢弃，不会错配给后面的指令。
+        """
+        queue = self._pending.get(item_code)
+        if not queue:
+            return
+        future = queue.popleft()
+        if future.done():
+            return
+        if result:
+            future.set_exception(SesameCommandError(item_code, result))
+        else:
+            future.set_result(payload)
+
+    def _fail_pending(self, exc):
+        for queue in self._pending.values():
+            for future in queue:
+                if not future.done():
+                    future.set_exception(exc)
+        self._pending.clear()
+
+    def _on_disconnected(self, client):
+        if not self._disconnecting:
+            logging.warning(f"{self.mac_address} 已断开，下一条指令会自动重新连接并登录。")
+        self._reset_session()
+        self.protocol.reset()
+        self.random_code_received_event.clear()
+
+    async def ensure_session(self):
+        """
+        保持已登录的链路：已登录时直接返回，链路断开或会话失效时才重新连接/登录。
+        多个协程同时调用时只会有一个去建立会话。
+        """
+        async with self._session_lock:
+            if self._drop_task is not None:
+                await self._drop_task
+                self._drop_task = None
+            if self.is_logged_in:
+                return True
+            if self.client is None or not self.client.is_connected:
+                if not await self.connect():
+                    return False
+            return await self.login()
 
     async def connect(self):
         logging.info(f"正在连接到 {self.mac_address}...")
+        self._reset_session()
+        self.protocol.reset()
+        self.random_code_received_event.clear()
         try:
-            self.client = BleakClient(self.mac_address, timeout=CONNECTION_TIMEOUT)
+            self.client = self.client_factory(self.mac_address, timeout=CONNECTION_TIMEOUT,
+                                              disconnected_callback=self._on_disconnected)
             await self.client.connect()
             await self.client.start_notify(STATUS_CHARACTERISTIC_UUID, self._notification_handler)
             logging.info("连接成功并已开启通知。")
@@ -41,118 +197,230 @@ class SesameController:
             return False
 
     async def disconnect(self):
-        if self.client and self.client.is_connected:
-            await self.client.disconnect()
+        if self._relogin_task:
+            self._relogin_task.cancel()
+            self._relogin_task = None
+        self._stop_keystream_filler()
+        if await self._drop_link():
             logging.info("已断开连接。")
 
+    def _drop_link_soon(self):
+        """在同步回调里断开链路；random code 作废，ensure_session() 会等断开完成后重新连接"""
+        self.random_code_received_event.clear()
+        if self._drop_task is None or self._drop_task.done():
+            self._drop_task = asyncio.ensure_future(self._drop_link())
+
+    async def _drop_link(self):
+        """主动断开链路（不视为意外断开）。之后的 ensure_session() 会重新连接，拿到新的 random code。"""
+        if not self.client or not self.client.is_connected or self._disconnecting:
+            return False
+        self._disconnecting = True
+        try:
+            await self.client.disconnect()
+        finally:
+            self._disconnecting = False
+        return True
+
     def _notification_handler(self, sender, data: bytes):
-        logging.info(f"[通知] 收到原始数据: {data.hex()}")
+        """
+        bleak 的通知回调。SesameProtocol 完成重组和解密后，按 (消息类型, item code)
+        查表分发，负载以 memoryview 传给处理函数，只有开启 DEBUG 日志时才格式化十六进制。
+        """
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        if debug:
+            logging.debug(f"[通知] 收到原始数据: {data.hex()}")
 
-        if data[0] == 5:
-            decrypted_data = self.decode(data[1:])
-            data  = data[0:1]+decrypted_data
-            self.rx_counter += 1
-            logging.info(f"[通知] 收到原始数据decode: {data.hex()}")
-        
-        match data[1]:
-            case 7:
-                logging.info("response msg")
-                
-                match data[2]:
-                    case 2:
-                        logging.info("login")
-                    case 4:
-                        logging.info("history")
-                    case 5:
-                        logging.info("version")
-            case 8:
-                logging.info("public msg")
-                match data[2]:
-                    case 14:
-                        logging.info("init sent random code")
-                    case 80:
-                        logging.info("setting")
-                    case 81:
-                        logging.info("status")
-
-        if not self.random_code_received_event.is_set() and data.startswith(b'\x03\x08\x0e'):
-            self.random_code = data[3:7]
-            logging.info(f"成功捕获到 random_code: {self.random_code.hex()}")
-            self.random_code_received_event.set()
+        message = self.protocol.receive(data)
+        if message is None:
+            return
+        self._keystream_wanted.set()
+        msg_type, item_code = message.msg_type, message.item_code
+        if debug:
+            logging.debug(f"[通知] 消息 type={msg_type} item={item_code}: {bytes(message.body).hex()}")
+        handler = self._dispatch.get((msg_type, item_code)) or self._dispatch.get((msg_type, None))
+        if handler is None:
+            return
+        handler(item_code, message.body)
+
+    def _on_auth_failed(self, item_code, body):
+        # 计数器已与锁错位，这个会话无法恢复：断开后由下一条指令重新登录
+        logging.error("[通知] 解密失败，消息认证码不匹配，断开重连。")
+        self._reset_session()
+        self._drop_link_soon()
+
+    def _on_response(self, item_code, body):
+        """(7, *)：指令应答，body = 结果码 || 负载"""
+        result = body[0] if len(body) else 0
+        logging.info(f"[通知] 应答 item code {item_code}，结果码 {result}")
+        self._resolve(item_code, result, bytes(body[1:]))
+
+    def _on_random_code(self, item_code, body):
+        """(8, 14)：锁推送了新的 random code（SesameProtocol 已结束旧会话）"""
+        stale = self._login_acked.is_set()
+        self._reset_session()
+        logging.info(f"成功捕获到 random_code: {self.random_code.hex()}")
+        self.random_code_received_event.set()
+        if stale:
+            # 锁在链路上换了 random code，旧会话作废，立刻在后台重新登录
+            logging.info("random code 已更新，重新登录。")
+            self._relogin_task = asyncio.ensure_future(self.ensure_session())
+
+    def _on_setting(self, item_code, body):
+        """(8, 80)：设置推送"""
+        logging.debug("[通知] 设置推送")
+
+    def _on_mech_status(self, item_code, body):
+        """(8, 81)：机械状态推送。大多数推送与上一次相同，只有字段变化时才通知 status_listeners。"""
+        if body == self._last_status_raw or len(body) < MechStatus.SIZE:
+            return
+        self._last_status_raw = bytes(body)
+        status = MechStatus.unpack(body)
+        if status == self.last_status:
+            return
+        self.last_status = status
+        self.status_received_event.set()
+        logging.info(f"[通知] {self.mac_address} 状态变化: {status}")
+        for listener in self.status_listeners:
+            listener(self.mac_address, status)
 
     async def _send_packet(self, data: bytes):
         await self.client.write_gatt_char(CMD_CHARACTERISTIC_UUID, data, response=False)
 
+    async def _send_fragments(self, fragments):
+        """依次写出 SesameProtocol 返回的分片；短消息就是一个 0x03 / 0x05 开头的包"""
+        for fragment in fragments:
+            await self._send_packet(fragment)
+
     def generate_session_key(self):
-        """最终确认的会话密钥生成算法"""
+        """最终确认的会话密钥生成算法。新会话的 tx/rx 计数器都从 0 开始。"""
         logging.info("正在生成会话密钥...")
-
-        token = CMAC.new(self.device_secret,self.random_code, ciphermod=AES)
-  
-        self.session_key = bytes.fromhex(token.digest().hex())
-
+        self._reset_session()
+        self.protocol.start_session()
         logging.info(f"已生成正确的会话密钥 (Token): {self.session_key.hex()}")
 
     async def login(self):
         logging.info("正在开始最终的登录流程...")
         try:
-            await asyncio.wait_for(self.random_code_received_event.wait(), timeout=10.0)
+            await asyncio.wait_for(self.random_code_received_event.wait(), timeout=RANDOM_CODE_TIMEOUT)
             self.generate_session_key()
-            pincode = self.session_key[:4]
-            login_payload = bytes([ITEM_CODE_LOGIN]) + pincode
-            packet_to_send = b'\x03' + login_payload
-            logging.info(f"发送标准登录指令: {packet_to_send.hex()}")
-            await self._send_packet(packet_to_send)
-            await asyncio.sleep(1.0)
+            self._start_keystream_filler()
+            fragments = self.protocol.login_request()
+            logging.info(f"发送标准登录指令: {b''.join(fragments).hex()}")
+            ack = self._expect(ITEM_CODE_LOGIN, LOGIN_TIMEOUT)
+            await self._send_fragments(fragments)
+            await ack
+            self._login_acked.set()
             logging.info("🎉 登录流程成功完成！")
             return True
         except Exception as e:
-            logging.error(f"登录失败: {e}")
+            logging.error(f"登录失败: {e!r}")
+            self._reset_session()
+            # random code 或登录应答可能已经丢失，断开后下次重新连接
+            await self._drop_link()
             return False
         
+    def _start_keystream_filler(self):
+        self._stop_keystream_filler()
+        self._keystream_wanted.set()
+        self._keystream_task = asyncio.create_task(self._keystream_filler(self.session))
+
+    def _stop_keystream_filler(self):
+        if self._keystream_task:
+            self._keystream_task.cancel()
+            self._keystream_task = None
+
+    async def _keystream_filler(self, session):
+        """
+        链路空闲时为接下来的 tx/rx 计数器预先计算 A_i 的加密结果。
+        tx 和 rx 各自一个 [counter, counter + KEYSTREAM_WINDOW) 窗口，窗口外的缓存都丢弃，
+        所以状态推送让 rx 远远领先 tx 时，缓存也不超过 2 * KEYSTREAM_WINDOW 个计数器。
+        """
+        while session is self.session:
+            await self._keystream_wanted.wait()
+            self._keystream_wanted.clear()
+            # tx 与 rx 使用同一种 nonce 格式，两个窗口重叠时同一个计数器的密钥流两边都能用
+            windows = ((self.tx_counter, self.tx_counter + KEYSTREAM_WINDOW),
+                       (self.rx_counter, self.rx_counter + KEYSTREAM_WINDOW))
+            session.retain(*windows)
+            for start, stop in windows:
+                for counter in range(start, stop):
+                    if session.prefill(counter, KEYSTREAM_BLOCKS):
+                        await asyncio.sleep(0)  # 每算完一个包就让出事件循环
+
     def encode(self, data: bytes):
-        nonce = bytes.fromhex(f"{self.tx_counter.to_bytes(9, "little").hex()}{self.random_code.hex()}")
-        cobj = AES.new(self.session_key, AES.MODE_CCM, nonce = nonce,mac_len=4)
-        cobj.update(bytes([0]))
-        enc_data, tag = cobj.encrypt_and_digest(data)
-        tag4 = tag[0:4]
-
-        return enc_data+ tag4
-       
+        return self.protocol.encode(data)
+
     def decode(self, data: bytes):
-        nonce = bytes.fromhex(f"{self.rx_counter.to_bytes(9, "little").hex()}{self.random_code.hex()}")
-        cobj = AES.new(self.session_key, AES.MODE_CCM, nonce = nonce,mac_len=4)
-        cobj.update(bytes([0]))
-        decode_data = cobj.decrypt(data[0:-4])
+        """返回解密后的明文；认证失败时返回 None"""
+        return self.protocol.decode(data)
 
-        return decode_data  
-        
-    async def _send_command(self, item_code: int, parameter: bytes = b''):
-        if not self.session_key:
-            logging.error("未登录，无法发送指令。")
-            return
-        try:
-            command = self.encode(bytes([item_code]) + parameter)
-          
-            self.tx_counter += 1
-            
-            packet_to_send = b'\x05' + command
-            op_str = {ITEM_CODE_UNLOCK: "开锁", ITEM_CODE_LOCK: "上锁"}.get(item_code, "未知操作")
-            
-            logging.info(f"发送 AES-GCM 加密后的'{op_str}'指令: {packet_to_send.hex()}")
-            await self._send_packet(packet_to_send)
-            logging.info(f"'{op_str}' 指令已发送。")
-        except Exception as e:
-            logging.error(f"发送指令'{op_str}'失败: {e}")
+    async def _send_command(self, item_code: int, parameter: bytes = b'', timeout=COMMAND_TIMEOUT):
+        """
+        加密并发送一条指令，返回该指令应答的 Future（结果为应答负载）。
+        不必等上一条指令的应答就可以继续发送，多条指令按计数器顺序写出。
+        """
+        if not await self.ensure_session():
+            raise ConnectionError(f"无法与 {self.mac_address} 建立会话，指令未发送。")
+        op_str = {ITEM_CODE_UNLOCK: "开锁", ITEM_CODE_LOCK: "上锁"}.get(item_code, "未知操作")
+        # 加密和写出必须在同一把锁内完成，否则计数器 n+1 的包可能先于 n 到达锁
+        async with self._write_lock:
+            fragments = self.protocol.command(item_code, parameter)
+            self._keystream_wanted.set()
+            response = self._expect(item_code, timeout)
 
-    async def lock(self):
+            logging.info(f"发送 AES-CCM 加密后的'{op_str}'指令 (计数器 {self.tx_counter - 1})")
+            try:
+                await self._send_fragments(fragments)
+            except Exception as e:
+                logging.error(f"发送指令'{op_str}'失败: {e}")
+                if not response.done():
+                    response.set_exception(e)
+                return response
+        logging.info(f"'{op_str}' 指令已发送。")
+        return response
+
+    async def lock(self, timeout=COMMAND_TIMEOUT):
         # 官方App和pysesameos2都使用了简化的payload
-        await self._send_command(ITEM_CODE_LOCK, b'\x03abc')
+        return await (await self._send_command(ITEM_CODE_LOCK, b'\x03abc', timeout))
+
+    async def unlock(self, timeout=COMMAND_TIMEOUT):
+        return await (await self._send_command(ITEM_CODE_UNLOCK, b'\x03abc', timeout))
+
+    async def version(self, timeout=COMMAND_TIMEOUT):
+        return await (await self._send_command(ITEM_CODE_VERSION, b'', timeout))
 
-    async def unlock(self):
-        await self._send_command(ITEM_CODE_UNLOCK, b'\x03abc')
+    async def iter_history(self, window=HISTORY_WINDOW, log=None, timeout=COMMAND_TIMEOUT):
+        """
+        逐条下载锁里的历史记录，产出 HistoryRecord。
+        同时保持最多 window 个请求在途，锁返回 RESULT_NOT_FOUND 后不再发新请求。
+        log 为 sesame_history.HistoryLog 时，每条记录同时追加到日志文件。
+        """
+        in_flight = deque()
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(in_flight) < window:
+                    in_flight.append(await self._send_command(ITEM_CODE_HISTORY, HISTORY_READ, timeout))
+                if not in_flight:
+                    return
+                try:
+                    payload = await in_flight.popleft()
+                except SesameCommandError as e:
+                    if e.result != RESULT_NOT_FOUND:
+                        raise
+                    exhausted = True
+                    continue
+                record = HistoryRecord.unpack(payload)
+                if log is not None:
+                    log.append(self.mac_address, record)
+                yield record
+        finally:
+            # 提前退出时，还在途的请求的应答会被 _resolve 丢弃
+            for future in in_flight:
+                future.cancel()
 
 async def main():
+    logging.info(f"Sesame 加密后端: {sesame_crypto.backend.name}")
     ################################################################
     DEVICE_SECRET_HEX = "813f956d0729a31a8620271e23d90822"
     SESAME_MAC_ADDRESS = "FA:EE:B1:3F:13:0F"
@@ -160,21 +428,19 @@ async def main():
     controller = None
     try:
         controller = SesameController(SESAME_MAC_ADDRESS, DEVICE_SECRET_HEX)
-        if await controller.connect():
-            if await controller.login():
-            #     await asyncio.sleep(1.0)
-            #     logging.info("初始化完成，现在可以控制您的芝麻锁了！")
-                
-                while True:
-                    action = input("\n请输入指令 'login','lock', 'unlock', 或 'exit': ").lower().strip()
-
-                    if action == "lock": await controller.lock()
+        if await controller.ensure_session():
+            while True:
+                action = input("\n请输入指令 'login','lock', 'unlock', 或 'exit': ").lower().strip()
+
+                try:
+                    if action == "lock": logging.info(f"上锁应答: {(await controller.lock()).hex()}")
                     elif action == "login": await controller.login()
-                    elif action == "unlock": await controller.unlock()
+                    elif action == "unlock": logging.info(f"开锁应答: {(await controller.unlock()).hex()}")
                     elif action == "exit": break
-                    await asyncio.sleep(2.0)
-                
-                logging.info("操作流程结束。")
+                except Exception as e:
+                    logging.error(f"指令失败: {e!r}")
+
+            logging.info("操作流程结束。")
     except Exception as e:
         logging.error(f"程序运行中发生意外错误: {e}")
     finally:
@@ -0,0 +1,350 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from s5WinApp import SesameController
+from sesame_history import HistoryLog
+
+# --- 常量定义 ---
+DEFAULT_MAX_CONNECTIONS = 5     # 同时保持的 BLE 连接数，按适配器能力设置
+DEFAULT_IDLE_TIMEOUT = 30.0     # 空闲连接超过该秒数后自动断开
+DEFAULT_COMMAND_TIMEOUT = 30.0  # 单条指令（含排队后的连接和登录）的超时
+
+_DEFAULT = object()
+
+
+class _PooledConnection:
+    """连接池中的一条已登录连接"""
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.in_use = False
+        self.last_used = time.monotonic()
+
+
+class ConnectionPool:
+    """
+    有上限的 BLE 连接池。
+
+    每把锁最多一条连接；连接数达到上限时，按 LRU 断开最久未用的空闲连接，
+    没有空闲连接时等待其他锁用完。同时统计连接池的利用率。
+    """
+
+    def __init__(self, locks, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, controller_factory=SesameController,
+                 status_listener=None):
+        self.locks = locks  # {mac_address: device_secret_hex}
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.controller_factory = controller_factory
+        self.status_listener = status_listener  # 挂到每个新建的 controller 上
+        self._connections = OrderedDict()  # mac -> _PooledConnection，按最近使用排序
+        self._connecting = 0
+        self._changed = asyncio.Condition()
+        self._notify_task = None
+
+        # 统计
+        self.connects = 0
+        self.connect_failures = 0
+        self.evictions = 0
+        self._busy_time = 0.0  # 在用连接数对时间的积分
+        self._busy_since = time.monotonic()
+        self._started = self._busy_since
+
+    def _in_use_count(self):
+        return sum(1 for c in self._connections.values() if c.in_use)
+
+    def _account(self):
+        now = time.monotonic()
+        self._busy_time += self._in_use_count() * (now - self._busy_since)
+        self._busy_since = now
+
+    async def acquire(self, mac):
+        """返回该锁已登录的 SesameController，必要时建立连接（可能先驱逐其他连接）"""
+        async with self._changed:
+            while True:
+                conn = self._connections.get(mac)
+                if conn is not None:
+                    # 锁那边断开时保留 controller：下一条指令由 ensure_session() 重新连接登录
+                    if not conn.in_use:
+                        self._account()
+                        conn.in_use = True
+                        self._connections.move_to_end(mac)
+                        return conn.controller
+                elif len(self._connections) + self._connecting < self.max_connections:
+                    break
+                else:
+                    victim = self._lru_idle()
+                    if victim is not None:
+                        await self._evict(victim)
+                        continue
+                await self._changed.wait()
+            self._connecting += 1
+
+        controller = None
+        pooled = False
+        try:
+            controller = self.controller_factory(mac, self.locks[mac])
+            if self.status_listener is not None:
+                controller.status_listeners.append(self.status_listener)
+            if not await controller.ensure_session():
+                raise ConnectionError(f"无法连接或登录 {mac}")
+            async with self._changed:
+                self._account()
+                conn = _PooledConnection(controller)
+                conn.in_use = True
+                self._connections[mac] = conn
+                pooled = True
+            self.connects += 1
+            return controller
+        except BaseException:
+            if not pooled:
+                self.connect_failures += 1
+                if controller is not None:
+                    await controller.disconnect()
+            raise
+        finally:
+            # 无论成功、失败还是被取消（包括等锁时被取消），都要归还这个连接名额
+            self._connecting -= 1
+            if not pooled:
+                self._notify_soon()
+
+    def _notify_soon(self):
+        """唤醒等待连接名额的协程。放在新任务里做，调用方可能正在被取消，不能在这里等锁。"""
+        async def notify():
+            async with self._changed:
+                self._changed.notify_all()
+        self._notify_task = asyncio.ensure_future(notify())
+
+    async def release(self, mac):
+        async with self._changed:
+            conn = self._connections.get(mac)
+            if conn is not None:
+                self._account()
+                conn.in_use = False
+                conn.last_used = time.monotonic()
+            self._changed.notify_all()
+
+    def _lru_idle(self):
+        for mac, conn in self._connections.items():
+            if not conn.in_use:
+                return mac
+        return None
+
+    async def _evict(self, mac):
+        """断开一条空闲连接。调用方需持有 self._changed。"""
+        conn = self._connections.pop(mac)
+        self.evictions += 1
+        logging.info(f"[连接池] 断开空闲连接 {mac}")
+        await conn.controller.disconnect()
+        self._changed.notify_all()
+
+    async def evict_idle(self):
+        """断开空闲时间超过 idle_timeout 的连接"""
+        now = time.monotonic()
+        async with self._changed:
+            for mac in [m for m, c in self._connections.items()
+                        if not c.in_use and now - c.last_used > self.idle_timeout]:
+                await self._evict(mac)
+
+    async def close(self):
+        async with self._changed:
+            for mac in list(self._connections):
+                await self._evict(mac)
+
+    def stats(self):
+        self._account()
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        return {
+            "max_connections": self.max_connections,
+            "connected": len(self._connections),
+            "in_use": self._in_use_count(),
+            "utilisation": self._busy_time / (elapsed * self.max_connections),
+            "connects": self.connects,
+            "connect_failures": self.connect_failures,
+            "evictions": self.evictions,
+        }
+
+
+class SesameFleet:
+    """
+    多把锁的并发控制器。
+
+    每把锁有自己的指令队列和工作协程，保证同一把锁的指令按顺序执行；
+    不同的锁之间并发执行，共享一个有上限的连接池。
+    """
+
+    def __init__(self, locks, max_connections=DEFAULT_MAX_CONNECTIONS,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, command_timeout=DEFAULT_COMMAND_TIMEOUT,
+                 controller_factory=SesameController):
+        self.pool = ConnectionPool(locks, max_connections, idle_timeout, controller_factory,
+                                   status_listener=self._on_status)
+        self.command_timeout = command_timeout
+        self._queues = {mac: asyncio.Queue() for mac in locks}
+        self._workers = []
+        self._reaper = None
+        self.last_status = {}  # mac -> MechStatus，连接被驱逐后仍保留
+        self._status_subscribers = []
+
+        # 排队等待时间统计 (秒)：从入队到拿到已登录连接
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._wait_count = 0
+
+    def subscribe_status(self, callback):
+        """订阅任意一把锁的状态变化：callback(mac, MechStatus)。重复的状态推送不会触发。"""
+        self._status_subscribers.append(callback)
+
+    def _on_status(self, mac, status):
+        if self.last_status.get(mac) == status:
+            return  # 重新连接后锁会再推一次同样的状态
+        self.last_status[mac] = status
+        for callback in self._status_subscribers:
+            callback(mac, status)
+
+    async def start(self):
+        self._workers = [asyncio.create_task(self._worker(mac)) for mac in self._queues]
+        self._reaper = asyncio.create_task(self._reap_idle())
+
+    async def stop(self):
+        for task in self._workers + [self._reaper]:
+            if task:
+                task.cancel()
+        await asyncio.gather(*self._workers, self._reaper, return_exceptions=True)
+        self._workers = []
+        self._reaper = None
+        await self.pool.close()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    def submit(self, mac, op, timeout=_DEFAULT):
+        """
+        把指令放进该锁的队列，返回一个 Future。
+        op 是接收已登录 SesameController 的协程函数，例如 lambda c: c.lock()。
+        timeout 是 op 整体的超时时间，默认 command_timeout；为 None 时由 op 自己负责超时。
+        """
+        if timeout is _DEFAULT:
+            timeout = self.command_timeout
+        future = asyncio.get_running_loop().create_future()
+        self._queues[mac].put_nowait((op, future, time.monotonic(), timeout))
+        return future
+
+    async def _worker(self, mac):
+        queue = self._queues[mac]
+        while True:
+            op, future, enqueued_at, timeout = await queue.get()
+            try:
+                if future.cancelled():
+                    continue
+                try:
+                    controller = await asyncio.wait_for(self.pool.acquire(mac), self.command_timeout)
+                except Exception as e:
+                    future.set_exception(e)
+                    continue
+                self._record_wait(time.monotonic() - enqueued_at)
+                try:
+                    result = await asyncio.wait_for(op(controller), timeout)
+                    if not future.cancelled():
+                        future.set_result(result)
+                except Exception as e:
+                    if not future.cancelled():
+                        future.set_exception(e)
+                finally:
+                    await self.pool.release(mac)
+            finally:
+                queue.task_done()
+
+    def _record_wait(self, wait):
+        self._wait_total += wait
+        self._wait_max = max(self._wait_max, wait)
+        self._wait_count += 1
+
+    async def _reap_idle(self):
+        while True:
+            await asyncio.sleep(max(self.pool.idle_timeout / 2, 0.1))
+            await self.pool.evict_idle()
+
+    # --- 常用指令 ---
+    def lock(self, mac):
+        return self.submit(mac, lambda controller: controller.lock())
+
+    def unlock(self, mac):
+        return self.submit(mac, lambda controller: controller.unlock())
+
+    def status(self, mac):
+        """
+        返回最近一次机械状态推送（登录后锁会主动推送）。
+        刚连上还没收到推送时等第一次推送，command_timeout 内没有收到则 Future 以 TimeoutError 结束。
+        """
+        async def _status(controller):
+            await controller.ensure_session()
+            await controller.status_received_event.wait()
+            return controller.last_status
+        return self.submit(mac, _status)
+
+    def history(self, mac, log=None):
+        """
+        下载该锁的全部历史记录，返回 HistoryRecord 列表（log 不为 None 时同时写入日志）。
+        记录多时下载会超过 command_timeout，所以超时按每个请求计算，整个下载没有总的超时。
+        """
+        async def _history(controller):
+            return [record async for record in controller.iter_history(log=log, timeout=self.command_timeout)]
+        return self.submit(mac, _history, timeout=None)
+
+    async def export_history(self, path, macs=None):
+        """把多把锁的历史记录并发导出到同一个只追加的日志文件，返回 {mac: 条数或异常}"""
+        macs = list(self._queues) if macs is None else macs
+        with HistoryLog(path) as log:
+            results = await asyncio.gather(*[self.history(mac, log) for mac in macs],
+                                           return_exceptions=True)
+        return {mac: r if isinstance(r, BaseException) else len(r) for mac, r in zip(macs, results)}
+
+    async def run_all(self, command, macs=None):
+        """
+        对多把锁并发执行同一指令 ('lock' / 'unlock' / 'status')。
+        返回 {mac: 结果或异常}。
+        """
+        macs = list(self._queues) if macs is None else macs
+        futures = [getattr(self, command)(mac) for mac in macs]
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        return dict(zip(macs, results))
+
+    def stats(self):
+        s = self.pool.stats()
+        s["queued"] = {mac: q.qsize() for mac, q in self._queues.items() if q.qsize()}
+        s["commands"] = self._wait_count
+        s["queue_wait_avg"] = self._wait_total / self._wait_count if self._wait_count else 0.0
+        s["queue_wait_max"] = self._wait_max
+        return s
+
+
+async def main():
+    ################################################################
+    LOCKS = {
+        "FA:EE:B1:3F:13:0F": "813f956d0729a31a8620271e23d90822",
+    }
+
+    async with SesameFleet(LOCKS, max_connections=DEFAULT_MAX_CONNECTIONS) as fleet:
+        while True:
+            action = input("\n请输入指令 'lock', 'unlock', 'status', 'history', 'stats' 或 'exit': ").lower().strip()
+            if action == "exit":
+                break
+            if action == "history":
+                logging.info(f"历史记录导出: {await fleet.export_history('history.bin')}")
+                continue
+            if action == "stats":
+                logging.info(f"连接池统计: {fleet.stats()}")
+                continue
+            if action in ("lock", "unlock", "status"):
+                for mac, result in (await fleet.run_all(action)).items():
+                    logging.info(f"{mac}: {result}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
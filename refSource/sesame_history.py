@@ -0,0 +1,105 @@
+import mmap
+import os
+import struct
+
+# 历史记录应答 (7/4) 的负载：record id (int32) | 类型 (uint8) | 时间戳 (uint32, 秒) | 参数
+_RECORD = struct.Struct("<iBI")
+# 日志文件中每条记录：地址长度 (uint8) | record id | 类型 | 时间戳 | 参数长度 (uint16)，后接地址和参数
+_LOG_ENTRY = struct.Struct("<BiBIH")
+# 日志文件开头的魔数和格式版本；记录布局变化时递增版本，旧文件不会被误读
+LOG_VERSION = 2
+_LOG_MAGIC = b"SSMHLOG" + bytes([LOG_VERSION])
+
+
+def _check_magic(header, path):
+    if header != _LOG_MAGIC:
+        raise ValueError(f"{path} is not a version {LOG_VERSION} Sesame history log.")
+
+
+class HistoryRecord:
+    """一条开关锁历史记录"""
+    __slots__ = ("record_id", "type", "timestamp", "param")
+
+    def __init__(self, record_id, type, timestamp, param=b""):
+        self.record_id = record_id
+        self.type = type
+        self.timestamp = timestamp
+        self.param = param
+
+    @classmethod
+    def unpack(cls, payload, offset=0):
+        record_id, type_, timestamp = _RECORD.unpack_from(payload, offset)
+        return cls(record_id, type_, timestamp, bytes(payload[offset + _RECORD.size:]))
+
+    def __eq__(self, other):
+        return (isinstance(other, HistoryRecord) and self.record_id == other.record_id
+                and self.type == other.type and self.timestamp == other.timestamp
+                and self.param == other.param)
+
+    def __repr__(self):
+        return (f"HistoryRecord(record_id={self.record_id}, type={self.type}, "
+                f"timestamp={self.timestamp}, param={self.param.hex()})")
+
+
+class HistoryLog:
+    """
+    只追加的二进制历史日志，多把锁的记录写在同一个文件里。
+    文件以 8 字节魔数和版本开头，之后每条记录是 12 字节定长头 + 地址 + 参数，可以用 scan() 直接 mmap 扫描。
+    追加到已有文件时先检查它的魔数和版本，格式不同时抛出 ValueError。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "ab")
+        try:
+            if self._file.tell() == 0:
+                self._file.write(_LOG_MAGIC)
+            else:
+                with open(path, "rb") as f:
+                    _check_magic(f.read(len(_LOG_MAGIC)), path)
+        except BaseException:
+            self._file.close()
+            raise
+        self.count = 0
+
+    def append(self, address, record):
+        addr = address.encode()
+        self._file.write(_LOG_ENTRY.pack(len(addr), record.record_id, record.type,
+                                         record.timestamp, len(record.param)))
+        self._file.write(addr)
+        self._file.write(record.param)
+        self.count += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def scan(path):
+    """
+    逐条产出日志文件中的 (address, HistoryRecord)。文件末尾写了一半的记录会被忽略。
+    文件不是当前版本的历史日志（例如旧版本写的文件）时抛出 ValueError。
+    """
+    if not os.path.getsize(path):
+        return
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        size = len(m)
+        _check_magic(m[:len(_LOG_MAGIC)], path)
+        pos = len(_LOG_MAGIC)
+        while pos + _LOG_ENTRY.size <= size:
+            addr_len, record_id, type_, timestamp, param_len = _LOG_ENTRY.unpack_from(m, pos)
+            start = pos + _LOG_ENTRY.size
+            end = start + addr_len + param_len
+            if end > size:
+                break
+            address = m[start:start + addr_len].decode()
+            yield address, HistoryRecord(record_id, type_, timestamp, m[start + addr_len:end])
+            pos = end
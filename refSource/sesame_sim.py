@@ -0,0 +1,359 @@
+import argparse
+import asyncio
+import logging
+import os
+import random
+import struct
+import sys
+import time
+
+# sesame_crypto / sesame_protocol 与 ESP32 固件共用，放在 src/ 下
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import sesame_crypto
+import sesame_protocol
+from sesame_protocol import MechStatus, MECH_FLAG_LOCK_RANGE, MECH_FLAG_UNLOCK_RANGE
+
+import s5WinApp
+from s5WinApp import SesameController
+
+# --- 常量定义 ---
+LOCKED_POSITION = 3
+UNLOCKED_POSITION = 400
+BATTERY_RAW = 0x0bfb  # 约 6.1 V
+NO_TARGET = -32768
+HISTORY_TYPE_LOCK = 1
+HISTORY_TYPE_UNLOCK = 2
+
+
+class _Pipe:
+    """单向内存链路：按发送顺序投递，每个包延迟 latency 秒，按 loss 概率丢弃"""
+
+    def __init__(self, deliver, latency, loss, rng):
+        self._deliver = deliver
+        self.latency = latency
+        self.loss = loss
+        self._rng = rng
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+        self.sent = 0
+        self.dropped = 0
+
+    def send(self, data):
+        self.sent += 1
+        if self.loss and self._rng.random() < self.loss:
+            self.dropped += 1
+            return
+        self._queue.put_nowait((time.monotonic() + self.latency, bytes(data)))
+
+    async def _run(self):
+        while True:
+            deliver_at, data = await self._queue.get()
+            delay = deliver_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._deliver(data)
+
+    def close(self):
+        self._task.cancel()
+
+
+class SimulatedLock:
+    """
+    锁端协议的模拟实现：连接后推送 random code，校验 CMAC 登录 token，
+    维护 tx/rx 计数器，解密指令并以加密应答回复，上锁/开锁后推送机械状态并记录历史。
+    """
+
+    def __init__(self, mac_address, device_secret_hex, backend=None, status_interval=None):
+        self.mac_address = mac_address
+        self.device_secret = bytes.fromhex(device_secret_hex)
+        # 可以与客户端使用不同的加密后端，顺便交叉验证两边的实现
+        self.backend = sesame_crypto.get_backend(backend) if backend else sesame_crypto.backend
+        self.status_interval = status_interval
+        self.locked = True
+        self.history = []  # 未被读取的 HistoryRecord 负载
+        self._next_record_id = 0
+        self.link = None
+
+        # 统计
+        self.logins = 0
+        self.commands = 0
+        self.auth_failures = 0
+
+    # --- 由 SimulatedClient 调用 ---
+    def attach(self, link):
+        """新连接：换一个 random code，计数器清零，推送 random code"""
+        self.link = link
+        self.random_code = os.urandom(4)
+        self.session = None
+        self.tx_counter = 0
+        self.rx_counter = 0
+        self._reassembler = sesame_protocol.Reassembler()
+        self._status_task = None
+        self._send(bytes([sesame_protocol.HEADER_PLAIN, sesame_protocol.MSG_TYPE_PUBLISH,
+                          sesame_protocol.ITEM_CODE_RANDOM_CODE]) + self.random_code)
+
+    def detach(self):
+        if self._status_task:
+            self._status_task.cancel()
+        self.link = None
+        self.session = None
+
+    def receive(self, data):
+        complete = self._reassembler.feed(data)
+        if complete is None:
+            return
+        encrypted, message = complete
+        if not encrypted:
+            if message[0] == sesame_protocol.ITEM_CODE_LOGIN:
+                self._on_login(bytes(message[1:]))
+            return
+        if self.session is None:
+            return
+        plaintext = self.session.open(self.rx_counter, message)
+        self.rx_counter += 1
+        if plaintext is None:
+            # 计数器错位或包被篡改：真实的锁会断开连接
+            self.auth_failures += 1
+            self.link.drop()
+            return
+        self.commands += 1
+        self._on_command(plaintext[0], plaintext[1:])
+
+    # --- 协议处理 ---
+    def _on_login(self, pincode):
+        token = self.backend.login_token(self.device_secret, self.random_code)
+        if pincode != token[:4]:
+            self.auth_failures += 1
+            self.link.drop()
+            return
+        self.logins += 1
+        self.session = self.backend.new_session(token, self.random_code)
+        self.tx_counter = 0
+        self.rx_counter = 0
+        self._respond(sesame_protocol.ITEM_CODE_LOGIN, 0, struct.pack("<I", int(time.time())))
+        self._push_status()
+        if self.status_interval:
+            self._status_task = asyncio.create_task(self._status_loop())
+
+    def _on_command(self, item_code, parameter):
+        if item_code in (sesame_protocol.ITEM_CODE_LOCK, sesame_protocol.ITEM_CODE_UNLOCK):
+            self.locked = item_code == sesame_protocol.ITEM_CODE_LOCK
+            self._record(HISTORY_TYPE_LOCK if self.locked else HISTORY_TYPE_UNLOCK)
+            self._respond(item_code, 0)
+            self._push_status()
+        elif item_code == sesame_protocol.ITEM_CODE_VERSION:
+            self._respond(item_code, 0, b"sim-1.0")
+        elif item_code == sesame_protocol.ITEM_CODE_HISTORY:
+            if self.history:
+                self._respond(item_code, 0, self.history.pop(0))
+            else:
+                self._respond(item_code, sesame_protocol.RESULT_NOT_FOUND)
+        else:
+            self._respond(item_code, 1)
+
+    def _record(self, type_):
+        self.history.append(struct.pack("<iBI", self._next_record_id, type_, int(time.time())))
+        self._next_record_id += 1
+
+    def status(self):
+        if self.locked:
+            return MechStatus(BATTERY_RAW, NO_TARGET, LOCKED_POSITION, MECH_FLAG_LOCK_RANGE)
+        return MechStatus(BATTERY_RAW, NO_TARGET, UNLOCKED_POSITION, MECH_FLAG_UNLOCK_RANGE)
+
+    def _push_status(self):
+        self._send_encrypted(bytes([sesame_protocol.MSG_TYPE_PUBLISH, sesame_protocol.ITEM_CODE_MECH_STATUS])
+                             + self.status().pack())
+
+    async def _status_loop(self):
+        while self.session is not None:
+            await asyncio.sleep(self.status_interval)
+            self._push_status()
+
+    def _respond(self, item_code, result, payload=b""):
+        self._send_encrypted(bytes([sesame_protocol.MSG_TYPE_RESPONSE, item_code, result]) + payload)
+
+    def _send_encrypted(self, message):
+        packet = self.session.seal(self.tx_counter, message)
+        self.tx_counter += 1
+        for fragment in sesame_protocol.segment(packet, encrypted=True):
+            self._send(fragment)
+
+    def _send(self, fragment):
+        if self.link is not None:
+            self.link.to_client.send(fragment)
+
+
+class SimulatedClient:
+    """
+    BleakClient 的内存替身，实现 SesameController 用到的接口。
+    由 LockSimulator.client_factory 创建。
+    """
+
+    def __init__(self, simulator, address, timeout=None, disconnected_callback=None):
+        self._simulator = simulator
+        self.address = address
+        self._disconnected_callback = disconnected_callback
+        self._notify = None
+        self._lock = None
+        self.to_client = None
+        self.to_lock = None
+        self.is_connected = False
+
+    async def connect(self):
+        lock = self._simulator.locks.get(self.address)
+        if lock is None:
+            raise ConnectionError(f"模拟器中没有 {self.address}")
+        if lock.link is not None:
+            raise ConnectionError(f"{self.address} 已被其他客户端连接")
+        await asyncio.sleep(self._simulator.connect_latency)
+        sim = self._simulator
+        self.to_client = _Pipe(self._deliver, sim.latency, sim.loss, sim.rng)
+        self.to_lock = _Pipe(lock.receive, sim.latency, sim.loss, sim.rng)
+        self._lock = lock
+        self.is_connected = True
+        return True
+
+    async def start_notify(self, uuid, callback):
+        self._notify = callback
+        self._lock.attach(self)
+
+    def _deliver(self, data):
+        if self._notify is not None:
+            self._notify(None, bytearray(data))
+
+    async def write_gatt_char(self, uuid, data, response=False):
+        if not self.is_connected:
+            raise ConnectionError("未连接")
+        self.to_lock.send(data)
+
+    def drop(self):
+        """断开链路（锁端主动断开或客户端 disconnect）"""
+        if not self.is_connected:
+            return
+        self.is_connected = False
+        self._lock.detach()
+        self.to_client.close()
+        self.to_lock.close()
+        if self._disconnected_callback:
+            self._disconnected_callback(self)
+
+    async def disconnect(self):
+        self.drop()
+        return True
+
+
+class LockSimulator:
+    """
+    一组模拟锁和它们共用的内存链路参数。
+    用法: SesameController(mac, secret, client_factory=simulator.client_factory)
+    """
+
+    def __init__(self, latency=0.0, loss=0.0, connect_latency=0.0, seed=None):
+        self.latency = latency
+        self.loss = loss
+        self.connect_latency = connect_latency
+        self.rng = random.Random(seed)
+        self.locks = {}
+
+    def add_lock(self, mac_address, device_secret_hex, **kwargs):
+        lock = SimulatedLock(mac_address, device_secret_hex, **kwargs)
+        self.locks[mac_address] = lock
+        return lock
+
+    def client_factory(self, address, timeout=None, disconnected_callback=None):
+        return SimulatedClient(self, address, timeout, disconnected_callback)
+
+    def stats(self):
+        locks = self.locks.values()
+        return {
+            "locks": len(self.locks),
+            "logins": sum(l.logins for l in locks),
+            "commands": sum(l.commands for l in locks),
+            "auth_failures": sum(l.auth_failures for l in locks),
+        }
+
+
+def _percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+async def run_benchmark(num_locks, commands, latency, loss, pipeline=1, backend=None, seed=1,
+                        timeout=s5WinApp.COMMAND_TIMEOUT):
+    """
+    num_locks 个 SesameController 并发连接各自的模拟锁，每个交替执行 commands 条开锁/上锁指令。
+    pipeline > 1 时每次同时发出这么多条指令。返回指令延迟统计。
+    """
+    simulator = LockSimulator(latency=latency, loss=loss, seed=seed)
+    secret = sesame_crypto.KNOWN_VECTORS["device_secret"].hex()
+    controllers = []
+    for i in range(num_locks):
+        mac = "5E:5A:00:00:%02X:%02X" % (i >> 8, i & 0xff)
+        simulator.add_lock(mac, secret, backend=backend)
+        controllers.append(SesameController(mac, secret, client_factory=simulator.client_factory))
+
+    latencies = []
+    failures = 0
+
+    async def timed(op):
+        nonlocal failures
+        start = time.perf_counter()
+        try:
+            await op(timeout)
+        except Exception:
+            failures += 1
+        else:
+            latencies.append(time.perf_counter() - start)
+
+    async def drive(controller):
+        sent = 0
+        while sent < commands:
+            batch = min(pipeline, commands - sent)
+            await asyncio.gather(*[timed(controller.unlock if (sent + i) % 2 else controller.lock)
+                                   for i in range(batch)])
+            sent += batch
+
+    start = time.perf_counter()
+    await asyncio.gather(*[c.ensure_session() for c in controllers])
+    login_time = time.perf_counter() - start
+    start = time.perf_counter()
+    await asyncio.gather(*[drive(c) for c in controllers])
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*[c.disconnect() for c in controllers])
+
+    latencies.sort()
+    result = simulator.stats()
+    result.update({
+        "login_time_s": login_time,
+        "elapsed_s": elapsed,
+        "ok": len(latencies),
+        "failures": failures,
+        "commands_per_s": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": _percentile(latencies, 0.50) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000,
+    })
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="模拟 Sesame 锁，压测 SesameController")
+    parser.add_argument("--locks", type=int, default=200, help="并发的锁/会话数")
+    parser.add_argument("--commands", type=int, default=20, help="每把锁执行的指令数")
+    parser.add_argument("--latency", type=float, default=0.005, help="单向链路延迟 (秒)")
+    parser.add_argument("--loss", type=float, default=0.0, help="丢包率 (0-1)")
+    parser.add_argument("--pipeline", type=int, default=1, help="每把锁同时在途的指令数")
+    parser.add_argument("--backend", default=None, help="模拟锁使用的加密后端（默认与客户端相同）")
+    parser.add_argument("--timeout", type=float, default=s5WinApp.COMMAND_TIMEOUT, help="单条指令超时 (秒)")
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(logging.WARNING)
+    result = asyncio.run(run_benchmark(args.locks, args.commands, args.latency, args.loss,
+                                       args.pipeline, args.backend, timeout=args.timeout))
+    for key, value in result.items():
+        print(f"{key:>16}: {value:.3f}" if isinstance(value, float) else f"{key:>16}: {value}")
+    return 1 if result["failures"] and not args.loss else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
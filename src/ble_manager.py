@@ -1,16 +1,131 @@
 # ble_manager.py
 import uasyncio as asyncio
 import aioble
-import bluetooth
 import time
 import struct
 from micropython import const
 # from settings_manager import settings_manager # 不再直接导入全局实例，而是通过构造函数传递或事件总线
 import config
+import sesame_protocol
+from scan_scheduler import ScanScheduler
+from device_registry import load_targets, SlotAllocator
+from reconnect_supervisor import ReconnectSupervisor
+from write_queue import DeviceWriteQueue
+from ring_buffer import RingBuffer
 from event_bus import event_bus # <-- 导入事件总线
 
 # ... (decode_name, decode_services 函数保持不变) ...
 
+# 外设接收环形缓冲区中记录的来源
+_RX_SOURCE_PERIPHERAL = const(0)
+_RX_SOURCE_CONFIG = const(1)
+
+# aioble ClientCharacteristic.properties 中的 GATT 特性属性位
+_FLAG_NOTIFY = const(0x0010)
+
+
+class SesameLink:
+    """
+    SesameProtocol 在 aioble 上的适配器：一条中心连接对应一把 Sesame 锁，
+    登录、加解密和指令应答都在 ESP32 上完成，不再把原始字节转发给 PC。
+    同一把锁的指令依次执行（一次只有一条在途），不同的锁各自独立。
+    """
+    def __init__(self, device_name, connection, write_char, notify_char, device_secret_hex):
+        self.device_name = device_name
+        self.connection = connection
+        self.write_char = write_char
+        self.notify_char = notify_char
+        # 加解密写进 SesameProtocol 预先分配的缓冲区，收发一个包不再为密文/明文分配内存
+        self.protocol = sesame_protocol.SesameProtocol(bytes.fromhex(device_secret_hex), in_place=True)
+        self.last_status = None
+        self._random_code_event = asyncio.Event()
+        self._response_event = asyncio.Event()
+        self._expected_item = None
+        self._response = None # (结果码, 负载)
+        self._logged_in_event = asyncio.Event()
+        self._command_lock = asyncio.Lock()
+
+    async def run(self):
+        """接收通知并交给 SesameProtocol，直到连接断开"""
+        try:
+            while self.connection.is_connected():
+                data = await self.notify_char.notified()
+                message = self.protocol.receive(data)
+                if message is not None:
+                    await self._handle(message)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"Sesame link {self.device_name} receive error: {e}")
+        finally:
+            self.protocol.reset()
+
+    async def _handle(self, message):
+        msg_type = message.msg_type
+        item_code = message.item_code
+        if msg_type == sesame_protocol.MSG_TYPE_RESPONSE:
+            if item_code == self._expected_item:
+                self._response = (message.result, bytes(message.payload))
+                self._response_event.set()
+        elif msg_type == sesame_protocol.MSG_TYPE_PUBLISH:
+            if item_code == sesame_protocol.ITEM_CODE_MECH_STATUS:
+                if len(message.body) < sesame_protocol.MechStatus.SIZE:
+                    return
+                status = sesame_protocol.MechStatus.unpack(message.body)
+                if status != self.last_status:
+                    self.last_status = status
+                    await event_bus.publish("sesame_status_changed", self.device_name, status.as_dict())
+            elif item_code == sesame_protocol.ITEM_CODE_RANDOM_CODE:
+                relogin = self._random_code_event.is_set()
+                self._random_code_event.set()
+                if relogin:
+                    print(f"Sesame {self.device_name}: new random code, logging in again.")
+                    self._logged_in_event.clear()
+                    asyncio.create_task(self.login())
+        elif msg_type == sesame_protocol.MSG_TYPE_AUTH_FAILED:
+            print(f"Sesame {self.device_name}: authentication failed, disconnecting.")
+            await self.connection.disconnect()
+
+    async def _request(self, item_code, fragments, timeout_ms):
+        """写出分片并等待 (7, item_code) 应答，返回 (结果码, 负载)"""
+        self._expected_item = item_code
+        self._response_event.clear()
+        for fragment in fragments:
+            await self.write_char.write(fragment, False)
+        try:
+            await asyncio.wait_for_ms(self._response_event.wait(), timeout_ms)
+        finally:
+            self._expected_item = None
+        return self._response
+
+    async def login(self, timeout_ms=config.SESAME_TIMEOUT_MS):
+        async with self._command_lock:
+            await asyncio.wait_for_ms(self._random_code_event.wait(), timeout_ms)
+            self.protocol.start_session()
+            result, _ = await self._request(sesame_protocol.ITEM_CODE_LOGIN,
+                                            self.protocol.login_request(), timeout_ms)
+            if result != sesame_protocol.RESULT_SUCCESS:
+                raise ValueError(f"Sesame {self.device_name} login rejected: {result}")
+            print(f"Sesame {self.device_name} logged in.")
+            self._logged_in_event.set()
+
+    async def wait_logged_in(self, timeout_ms=config.SESAME_TIMEOUT_MS):
+        await asyncio.wait_for_ms(self._logged_in_event.wait(), timeout_ms)
+
+    async def command(self, item_code, parameter=b"", timeout_ms=config.SESAME_TIMEOUT_MS):
+        """发送一条加密指令，返回 (结果码, 负载)"""
+        async with self._command_lock:
+            if not self.protocol.logged_in:
+                raise ValueError(f"Sesame {self.device_name} is not logged in.")
+            return await self._request(item_code, self.protocol.command(item_code, parameter), timeout_ms)
+
+    async def lock(self):
+        return await self.command(sesame_protocol.ITEM_CODE_LOCK, b"\x03abc")
+
+    async def unlock(self):
+        return await self.command(sesame_protocol.ITEM_CODE_UNLOCK, b"\x03abc")
+
+
 class BLEManager:
     # 构造函数中可以注入 event_bus 和 settings_manager
     def __init__(self, ble_name="ESP32_Dual_AIOBLE", settings_manager_instance=None):
@@ -27,20 +142,34 @@ class BLEManager:
         self.config_service = aioble.Service(config.SERVICE_UUID_CONFIG)
         self.config_data_char = aioble.Characteristic(
             self.config_service, config.CHAR_UUID_CONFIG_DATA,
-            read=True, write=True, notify=False, indicate=False
+            read=True, write=True, notify=False, indicate=False, capture=True
         )
         aioble.register_services(self.config_service)
         print("Config service registered.")
         # 设置特性初始值，确保在PC/手机读取时能获取到当前配置
         self.config_data_char.write(self.settings_manager.get_all_settings_json().encode())
+        event_bus.subscribe("settings_updated", self._refresh_config_char)
+
+        # 外设 RX / 配置特性收到的写入先放进环形缓冲区，由 _peripheral_rx_consumer 处理
+        self.peripheral_rx_ring = RingBuffer(config.PERIPHERAL_RX_BUFFER_BYTES, config.PERIPHERAL_RX_MAX_RECORD)
+        self._peripheral_rx_event = asyncio.Event()
 
         self.central_connections = {}
         self.central_devices_info = {}
-        self.target_devices = [
-            (config.TARGET_DEVICE_1_NAME, config.TARGET_DEVICE_1_SERVICE_UUID, config.TARGET_DEVICE_1_CHAR_UUID_WRITE, config.TARGET_DEVICE_1_CHAR_UUID_NOTIFY),
-            (config.TARGET_DEVICE_2_NAME, config.TARGET_DEVICE_2_SERVICE_UUID, config.TARGET_DEVICE_2_CHAR_UUID_WRITE, config.TARGET_DEVICE_2_CHAR_UUID_NOTIFY)
-        ]
-        self.desired_central_connections = len(self.target_devices)
+        self.sesame_links = {} # device_name -> SesameLink
+        # 扫描时被动记录 Sesame 广播中的锁状态，不需要连接
+        self.sesame_adv_index = sesame_protocol.AdvertisementIndex()
+        # 目标设备来自设置 "ble_devices"，按优先级排序；槽位分配决定哪些常驻、哪些按需连接
+        self.target_devices = load_targets(self.settings_manager)
+        self.slots = SlotAllocator(self.target_devices)
+        self._ready_events = {} # 设备名 -> asyncio.Event，写特性发现后置位
+        self.write_queues = {} # 设备名 -> DeviceWriteQueue
+        self._write_tasks = {}
+        print(f"Central targets: {self.target_devices}, slots: {self.slots.stats()}")
+        self._build_target_index()
+        self._seen = {} # 地址 -> 最近一次处理的 ticks_ms
+        self.scan_scheduler = ScanScheduler()
+        self.reconnect = ReconnectSupervisor()
 
         # aioble.active(True)
         print("BLE Manager initialized with aioble.")
@@ -48,7 +177,7 @@ class BLEManager:
     async def _peripheral_advertiser(self):
         peripheral_service = aioble.Service(config.SERVICE_UUID_PERIPHERAL)
         self.peripheral_rx_char = aioble.Characteristic(
-            peripheral_service, config.CHAR_UUID_PERIPHERAL_RX, read=False, write=True, notify=False, indicate=False
+            peripheral_service, config.CHAR_UUID_PERIPHERAL_RX, read=False, write=True, notify=False, indicate=False, capture=True
         )
         self.peripheral_tx_char = aioble.Characteristic(
             peripheral_service, config.CHAR_UUID_PERIPHERAL_TX, read=True, write=False, notify=True, indicate=False
@@ -57,6 +186,11 @@ class BLEManager:
 
         print("Peripheral services registered.")
 
+        # 写入由 written() 事件驱动，与是否正在广播无关，只需启动一次
+        asyncio.create_task(self._peripheral_rx_listener(self.peripheral_rx_char, _RX_SOURCE_PERIPHERAL))
+        asyncio.create_task(self._peripheral_rx_listener(self.config_data_char, _RX_SOURCE_CONFIG))
+        asyncio.create_task(self._peripheral_rx_consumer())
+
         # adv_data = aioble.advertising.encode_name(self.ble_name) + \
         #            aioble.advertising.encode_services([config.SERVICE_UUID_CONFIG])
                 #    aioble.advertising.encode_services([config.SERVICE_UUID_PERIPHERAL, config.SERVICE_UUID_CONFIG])
@@ -76,27 +210,8 @@ class BLEManager:
                     # 发布连接事件
                     await event_bus.publish("ble_peripheral_connected", connection.device.addr_hex())
 
-                    while connection.is_connected():
-                        await asyncio.sleep(2)  # 保持连接状态
-   
-                    # async for request in connection.requests():
-                    #         print(f"Received request from ###########{connection.device}: {request}")
-                    #         if request.is_peer_write:
-                    #             if request.characteristic is self.peripheral_rx_char:
-                    #                 data = await request.read()
-                    #                 print(f"Peripheral (App) received data from {connection.device}: {data.decode()}")
-                    #                 # 发布 BLE 外设接收数据事件
-                    #                 await event_bus.publish("ble_peripheral_data_received", data.decode())
-                    #             elif request.characteristic is self.config_data_char:
-                    #                 data = await request.read()
-                    #                 print(f"Peripheral (Config) received data from {connection.device}: {data.decode()}")
-                    #                 # 发布配置更新请求事件
-                    #                 await event_bus.publish("settings_update_request", data.decode())
-
-                    #         elif request.is_peer_read and request.characteristic is self.config_data_char:
-                    #             # 客户端读取配置特性时，返回当前保存的配置
-                    #             request.write(self.settings_manager.get_all_settings_json().encode())
-                    #             print(f"Peripheral (Config) sent current settings to {connection.device}.")
+                    # 写入由 _peripheral_rx_listener 处理，这里只等待断开
+                    await connection.disconnected(timeout_ms=None)
 
             except asyncio.CancelledError:
                 print("Peripheral advertising task cancelled.")
@@ -110,6 +225,47 @@ class BLEManager:
                 print("Peripheral disconnected, restarting advertisement.")
                 await asyncio.sleep_ms(100)
 
+    async def _peripheral_rx_listener(self, characteristic, source):
+        """等待特性被写入，把数据原样放进环形缓冲区后立即返回继续等待"""
+        while True:
+            try:
+                _, data = await characteristic.written()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                print(f"Peripheral write listener error: {e}")
+                continue
+            if not self.peripheral_rx_ring.put(source, data):
+                print(f"Peripheral RX buffer full, dropped {len(data)} bytes.")
+            self._peripheral_rx_event.set()
+
+    async def _peripheral_rx_consumer(self):
+        """按写入顺序取出缓冲区中的记录：RX 数据发布给主程序，配置数据交给设置管理器"""
+        while True:
+            await self._peripheral_rx_event.wait()
+            self._peripheral_rx_event.clear()
+            while True:
+                record = self.peripheral_rx_ring.get()
+                if record is None:
+                    break
+                source, data = record
+                if source == _RX_SOURCE_CONFIG:
+                    try:
+                        text = bytes(data).decode()
+                    except UnicodeError:
+                        print("Peripheral (Config) received non-UTF-8 data, ignored.")
+                        continue
+                    print(f"Peripheral (Config) received data: {text}")
+                    # 发布配置更新请求事件
+                    await event_bus.publish("settings_update_request", text)
+                else:
+                    # 发布 BLE 外设接收数据事件（原始字节）
+                    await event_bus.publish("ble_peripheral_data_received", bytes(data))
+
+    def _refresh_config_char(self, new_settings):
+        """设置更新后刷新配置特性的值，客户端读取时得到当前配置"""
+        self.config_data_char.write(self.settings_manager.get_all_settings_json().encode())
+
     async def peripheral_send_data(self, data):
         if self.peripheral_connection and self.peripheral_tx_char:
             try:
@@ -120,54 +276,186 @@ class BLEManager:
         else:
             print("No peripheral connection or tx_char available to send data.")
 
+    def _build_target_index(self):
+        """按名称、服务 UUID 预建目标设备索引；地址索引在第一次匹配成功后填入"""
+        self._targets_by_name = {}
+        self._targets_by_addr = {}
+        services = {}
+        for target in self.target_devices:
+            self._targets_by_name[target.name] = target
+            services.setdefault(target.service_uuid, []).append(target)
+        # 只有唯一对应一个目标的服务 UUID 才能在广播里没有名称时用来识别设备
+        self._targets_by_service = {uuid: targets[0] for uuid, targets in services.items() if len(targets) == 1}
+
+    def _match_target(self, result, addr_str):
+        """返回广播对应的 TargetDevice，不是目标时返回 None"""
+        target = self._targets_by_addr.get(addr_str)
+        if target is not None:
+            return target
+        device_name = result.name()
+        if device_name:
+            target = self._targets_by_name.get(device_name)
+            if target is None:
+                return None
+            for uuid in result.services():
+                if uuid == target.service_uuid:
+                    self._targets_by_addr[addr_str] = target
+                    return target
+            return None
+        for uuid in result.services():
+            target = self._targets_by_service.get(uuid)
+            if target is not None:
+                self._targets_by_addr[addr_str] = target
+                return target
+        return None
+
+    def _seen_recently(self, addr_str):
+        """同一地址在 SEEN_CACHE_TTL_MS 内只处理一次；返回 True 表示跳过"""
+        now = time.ticks_ms()
+        last = self._seen.get(addr_str)
+        if last is not None and time.ticks_diff(now, last) < config.SEEN_CACHE_TTL_MS:
+            return True
+        if last is None and len(self._seen) >= config.SEEN_CACHE_MAX:
+            self._prune_seen(now)
+        self._seen[addr_str] = now
+        return False
+
+    def _prune_seen(self, now):
+        for addr in [a for a, t in self._seen.items() if time.ticks_diff(now, t) >= config.SEEN_CACHE_TTL_MS]:
+            del self._seen[addr]
+        if len(self._seen) >= config.SEEN_CACHE_MAX:
+            self._seen.clear()
+
+    def _expire_passive(self):
+        """
+        每轮扫描结束后删除太久没有广播的锁，sesame_state() 不会返回离开或断电的锁的旧状态；
+        扫描调度也不再为它们保持 search 占空比。
+        """
+        self.sesame_adv_index.expire(time.time(), config.SESAME_ADV_MAX_AGE_S)
+        self.scan_scheduler.expire(time.ticks_ms(), config.SESAME_ADV_MAX_AGE_S * 1000)
+
+    def _forget_seen(self, device_name):
+        """设备断开后立即允许再次匹配它的地址，不必等去重缓存过期"""
+        for addr, target in self._targets_by_addr.items():
+            if target.name == device_name:
+                self._seen.pop(addr, None)
+
     async def _central_scanner_and_connector(self):
-        while len(self.central_connections) < self.desired_central_connections:
-            print("Starting BLE scan for target devices...")
+        """
+        唯一的长时间运行扫描任务。每轮 SCAN_EPOCH_MS，开始前由 ScanScheduler 选择占空比；
+        找到需要连接的目标时提前结束本轮去连接，之后立即继续扫描。
+        Sesame 广播在整个过程中持续被记录。
+        """
+        profile = None
+        while True:
+            found = None
+            now = time.ticks_ms()
+            name, interval_us, window_us = self.scan_scheduler.choose(now, self.slots.missing())
+            if name != profile:
+                print(f"BLE scan profile: {name} ({window_us}/{interval_us} us), stats: {self.scan_scheduler.stats()}")
+                profile = name
             try:
                 async with aioble.scan(
-                    config.SCAN_DURATION_MS,
-                    interval_us=config.SCAN_INTERVAL_US,
-                    window_us=config.SCAN_WINDOW_US
+                    config.SCAN_EPOCH_MS,
+                    interval_us=interval_us,
+                    window_us=window_us
                 ) as scanner:
                     async for result in scanner:
                         addr_str = result.device.addr_hex()
-                        device_name = result.name()
-                        device_services = result.services()
-                        # manufacturer_data = [f"{man_id:04X}" for man_id, man_data in result.manufacturer()]
-                        # result.adv_data
-                        
-                        print(f"Found device:{result.name()} ({addr_str}), RSSI: {result.rssi}")
-
-                        for target_name, target_service_uuid, _, _ in self.target_devices:
-                            if device_name == target_name and \
-                                target_service_uuid in device_services and \
-                                device_name not in self.central_connections:
-                                print(f"Found target device: {device_name} ({addr_str}), RSSI: {result.rssi}")
-                                try:
-                                    print(f"Attempting to connect to {device_name}...")
-                                    connection = await result.device.connect()
-                                    self.central_connections[device_name] = connection
-                                    self.central_devices_info[device_name] = {'conn': connection, 'services': {}, 'chars': {}}
-                                    print(f"Central connected to {device_name} ({addr_str})")
-                                    # 发布主机连接事件
-                                    await event_bus.publish("ble_central_connected", device_name, addr_str)
-                                    asyncio.create_task(self._handle_central_connection(device_name, connection))
-                                    if len(self.central_connections) >= self.desired_central_connections:
-                                        print("All target devices connected, stopping scan.")
-                                        return
-                                except asyncio.TimeoutError:
-                                    print(f"Connection to {device_name} timed out.")
-                                except Exception as e:
-                                    print(f"Failed to connect to {device_name}: {e}")
+                        for _, man_data in result.manufacturer(sesame_protocol.SESAME_COMPANY_ID):
+                            await self._on_sesame_advertisement(addr_str, man_data, result.rssi)
+                        # 扫描调度只跟踪已识别、未连接的目标设备，路过的陌生设备不影响占空比
+                        known = self._targets_by_addr.get(addr_str)
+                        if known is not None and known.name not in self.central_connections:
+                            self.scan_scheduler.observe(addr_str, result.rssi, time.ticks_ms())
+                        if self._seen_recently(addr_str):
+                            continue
+                        target = self._match_target(result, addr_str)
+                        if target is not None and self.slots.wants(target.name):
+                            if self.reconnect.due(target.name, time.ticks_ms()):
+                                found = (target, result, addr_str)
+                                break
+                            # 还在退避中：不记入去重缓存，退避结束后的下一条广播就能连接
+                            self._seen.pop(addr_str, None)
             except asyncio.CancelledError:
                 print("Central scanning task cancelled.")
                 break
             except Exception as e:
                 print(f"Central scanning error: {e}")
+                await asyncio.sleep(1)
+            self.scan_scheduler.account(name, time.ticks_diff(time.ticks_ms(), now))
+            self._expire_passive()
 
-            if len(self.central_connections) < self.desired_central_connections:
-                print("Scan finished, not all target devices connected. Retrying scan in 5 seconds...")
-                await asyncio.sleep(5)
+            if found is not None:
+                try:
+                    await self._connect_target(*found)
+                except asyncio.CancelledError:
+                    print("Central scanning task cancelled.")
+                    break
+                except Exception as e:
+                    # 扫描任务是唯一的重连者，不能因为一次连接出错而退出
+                    print(f"Error connecting to {found[0].name}: {e}")
+
+    async def _connect_target(self, target, result, addr_str):
+        device_name = target.name
+        print(f"Found target device: {device_name} ({addr_str}), RSSI: {result.rssi}")
+        if not self.reconnect.begin(device_name, time.ticks_ms()):
+            return
+        try:
+            # 腾出槽位也放在 try 里：disconnect() 可能超时，失败要报告给 ReconnectSupervisor，
+            # 否则设备会一直处于 connecting 状态
+            victim = self.slots.victim(device_name)
+            if victim is not None and victim in self.central_connections:
+                print(f"All rotating slots in use, releasing {victim} for {device_name}.")
+                await self.central_connections[victim].disconnect()
+            print(f"Attempting to connect to {device_name}...")
+            connection = await result.device.connect()
+            self._targets_by_addr[addr_str] = target
+            now = time.ticks_ms()
+            # 已连接的设备不再广播，不能再按“太久没出现”来判断
+            self.scan_scheduler.forget(addr_str)
+            self.reconnect.on_connected(device_name, now)
+            self.slots.on_connected(device_name, now)
+            self.central_connections[device_name] = connection
+            self.central_devices_info[device_name] = {'conn': connection, 'services': {}, 'chars': {}}
+            print(f"Central connected to {device_name} ({addr_str})")
+            # 发布主机连接事件
+            await event_bus.publish("ble_central_connected", device_name, addr_str)
+            asyncio.create_task(self._handle_central_connection(device_name, connection))
+        except asyncio.TimeoutError:
+            print(f"Connection to {device_name} timed out.")
+            self._connect_failed(device_name)
+        except Exception as e:
+            print(f"Failed to connect to {device_name}: {e}")
+            self._connect_failed(device_name)
+
+    def _connect_failed(self, device_name):
+        now = time.ticks_ms()
+        retry_at = self.reconnect.on_failure(device_name, now)
+        # 只由退避决定何时重试：去重缓存 (SEEN_CACHE_TTL_MS) 不能再额外压住它的广播
+        self._forget_seen(device_name)
+        print(f"Retrying {device_name} in {time.ticks_diff(retry_at, now)} ms.")
+
+    def write_stats(self):
+        """每个已连接设备的 MTU 和发送队列统计"""
+        return {name: queue.stats() for name, queue in self.write_queues.items()}
+
+    def reconnect_stats(self):
+        """每个设备的连接尝试次数、失败次数和从断开到重新连上的耗时"""
+        return self.reconnect.stats()
+
+    async def _on_sesame_advertisement(self, addr_str, man_data, rssi):
+        adv = self.sesame_adv_index.update(addr_str, man_data, rssi, time.time())
+        if adv is not None:
+            await event_bus.publish("sesame_adv_state_changed", addr_str, adv.state)
+
+    def scan_stats(self):
+        """扫描占空比和无线时间统计，见 ScanScheduler.stats()"""
+        return self.scan_scheduler.stats()
+
+    def sesame_state(self, addr_str):
+        """从广播得到的锁状态 ('locked' / 'unlocked' / 'moving')，没收到过广播时返回 None"""
+        return self.sesame_adv_index.state(addr_str)
 
     async def _handle_central_connection(self, device_name, connection):
         try:
@@ -177,25 +465,36 @@ class BLEManager:
                     if device_name in self.central_connections:
                         del self.central_connections[device_name]
                         del self.central_devices_info[device_name]
+                    self.sesame_links.pop(device_name, None)
+                    self.slots.on_disconnected(device_name)
+                    self.reconnect.on_disconnected(device_name, time.ticks_ms())
+                    self._stop_write_queue(device_name)
                     # 发布主机断开连接事件
                     await event_bus.publish("ble_central_disconnected", device_name)
-                    asyncio.create_task(self._central_scanner_and_connector())
+                    # 扫描任务是唯一的重连者：设备再次广播且 ReconnectSupervisor 允许时重新连接
+                    self._forget_seen(device_name)
+                    if self.slots.is_resident(device_name):
+                        self.scan_scheduler.on_disconnect(time.ticks_ms())
                     break
 
                 elif event == aioble.Event.GATTC_SERVICE_DISCOVERED:
                     service = data
                     print(f"  Service discovered for {device_name}: {service.uuid}")
                     self.central_devices_info[device_name]['services'][service.uuid] = service
+                    target = self._targets_by_name[device_name]
                     for char in await service.discover_characteristics():
                         print(f"    Characteristic discovered: {char.uuid}")
                         self.central_devices_info[device_name]['chars'][char.uuid] = char
-                        for target_name, _, _, target_char_notify_uuid in self.target_devices:
-                            if target_name == device_name and char.uuid == target_char_notify_uuid:
-                                if char.props & bluetooth.Characteristic.PROP_NOTIFY:
-                                    await char.subscribe(notify=True)
-                                    print(f"      Subscribed to notifications for {device_name} char {char.uuid}")
-                                    asyncio.create_task(self._handle_notification(device_name, char))
-                                break
+                        if char.uuid == target.notify_uuid and char.properties & _FLAG_NOTIFY:
+                            await char.subscribe(notify=True)
+                            print(f"      Subscribed to notifications for {device_name} char {char.uuid}")
+                            # Sesame 锁的通知由 SesameLink 接收，其他设备原样转发
+                            if device_name not in config.SESAME_LOCKS:
+                                asyncio.create_task(self._handle_notification(device_name, char))
+                    self._maybe_start_sesame_link(device_name, connection)
+                    write_char = self.central_devices_info[device_name]['chars'].get(target.write_uuid)
+                    if write_char is not None and device_name not in self.write_queues:
+                        self._start_write_queue(device_name, connection, write_char)
 
                 elif event == aioble.Event.GATTC_CHARACTERISTIC_READ:
                     char, data_read = data
@@ -211,33 +510,137 @@ class BLEManager:
                 await self.central_connections[device_name].disconnect()
                 del self.central_connections[device_name]
                 del self.central_devices_info[device_name]
-            asyncio.create_task(self._central_scanner_and_connector())
+            self.sesame_links.pop(device_name, None)
+            self.slots.on_disconnected(device_name)
+            # 连接上之后出错（例如服务发现失败）按失败退避，避免反复连接同一台坏设备
+            self._connect_failed(device_name)
+            self._stop_write_queue(device_name)
+            self._forget_seen(device_name)
+            if self.slots.is_resident(device_name):
+                self.scan_scheduler.on_disconnect(time.ticks_ms())
+
+    def _start_write_queue(self, device_name, connection, write_char):
+        """写特性已发现：创建发送队列和写入任务，设备进入可写状态"""
+        queue = DeviceWriteQueue(device_name, connection, write_char)
+        self.write_queues[device_name] = queue
+        self._write_tasks[device_name] = asyncio.create_task(self._run_write_queue(device_name, queue))
+        self._ready_event(device_name).set()
+
+    async def _run_write_queue(self, device_name, queue):
+        await queue.run()
+        if self.write_queues.get(device_name) is not queue:
+            return # 连接断开时已经注销
+        # 写入任务出错退出：注销队列并断开连接，扫描任务重连后会建立新的队列
+        self._write_tasks.pop(device_name, None)
+        self._stop_write_queue(device_name)
+        connection = self.central_connections.get(device_name)
+        if connection is not None:
+            await connection.disconnect()
+
+    def _stop_write_queue(self, device_name):
+        self._ready_events.pop(device_name, None)
+        self.write_queues.pop(device_name, None)
+        task = self._write_tasks.pop(device_name, None)
+        if task is not None:
+            task.cancel()
+
+    def _ready_event(self, device_name):
+        event = self._ready_events.get(device_name)
+        if event is None:
+            event = self._ready_events[device_name] = asyncio.Event()
+        return event
+
+    async def _ensure_connected(self, device_name):
+        """
+        确保设备已连接且写特性可用。按需设备会申请槽位并让扫描任务尽快连接它，
+        最多等待 ON_DEMAND_CONNECT_TIMEOUT_MS。返回是否可用。
+        """
+        if device_name not in self._targets_by_name:
+            print(f"Unknown target device: {device_name}")
+            return False
+        now = time.ticks_ms()
+        if device_name not in self.central_connections:
+            self.slots.request(device_name, now)
+            self._forget_seen(device_name)
+            self.scan_scheduler.boost(now)
+        try:
+            await asyncio.wait_for_ms(self._ready_event(device_name).wait(), config.ON_DEMAND_CONNECT_TIMEOUT_MS)
+        except asyncio.TimeoutError:
+            print(f"Timed out waiting for {device_name} to connect.")
+            return False
+        self.slots.touch(device_name, time.ticks_ms())
+        return True
+
+    async def _release_idle_connections(self):
+        """释放空闲的按需连接，放弃过期的连接请求"""
+        now = time.ticks_ms()
+        self.slots.expire_demand(now)
+        for device_name in self.slots.idle(now):
+            connection = self.central_connections.get(device_name)
+            if connection is not None:
+                print(f"Releasing idle on-demand connection to {device_name}.")
+                await connection.disconnect()
+
+    def _maybe_start_sesame_link(self, device_name, connection):
+        """Sesame 锁的写/通知特性都已发现后，在这条连接上启动 SesameLink 并登录"""
+        secret = config.SESAME_LOCKS.get(device_name)
+        if secret is None or device_name in self.sesame_links:
+            return
+        chars = self.central_devices_info[device_name]['chars']
+        write_char = chars.get(config.SESAME_CHAR_UUID_WRITE)
+        notify_char = chars.get(config.SESAME_CHAR_UUID_NOTIFY)
+        if write_char is None or notify_char is None:
+            return
+        link = SesameLink(device_name, connection, write_char, notify_char, secret)
+        self.sesame_links[device_name] = link
+        asyncio.create_task(link.run())
+        asyncio.create_task(self._sesame_login(link))
+
+    async def _sesame_login(self, link):
+        try:
+            await link.login()
+            await event_bus.publish("sesame_logged_in", link.device_name)
+        except Exception as e:
+            print(f"Sesame {link.device_name} login failed: {e}")
+            await link.connection.disconnect()
+
+    async def sesame_command(self, device_name, action):
+        """对 Sesame 锁执行 'lock' / 'unlock'（需要时先连接并登录），返回 (结果码, 负载)；失败时返回 None"""
+        if not await self._ensure_connected(device_name):
+            return None
+        link = self.sesame_links.get(device_name)
+        if link is None:
+            print(f"No Sesame link for device: {device_name}")
+            return None
+        try:
+            await link.wait_logged_in()
+            return await getattr(link, action)()
+        except Exception as e:
+            print(f"Sesame {device_name} {action} failed: {e}")
+            return None
 
     async def _handle_notification(self, device_name, characteristic):
+        # 通知按原始字节转发（可能是二进制或加密数据），不做 decode
+        device_id = self._targets_by_name[device_name].device_id
         try:
             async for data in characteristic.notifications():
-                print(f"Central received notification from {device_name} char {characteristic.uuid}: {data.decode()}")
                 # 发布主机接收通知事件
-                await event_bus.publish("ble_central_notification_received", device_name, characteristic.uuid, data.decode())
+                await event_bus.publish("ble_central_notification_received", device_name, device_id, data)
         except asyncio.CancelledError:
             print(f"Notification handler for {device_name} cancelled.")
         except Exception as e:
             print(f"Error in notification handler for {device_name}: {e}")
 
     async def central_write_data(self, target_device_name, data):
-        if target_device_name in self.central_devices_info:
-            device_info = self.central_devices_info[target_device_name]
-            for target_name, _, target_char_write_uuid, _ in self.target_devices:
-                if target_name == target_device_name and target_char_write_uuid in device_info['chars']:
-                    char = device_info['chars'][target_char_write_uuid]
-                    try:
-                        await char.write(data, response=False)
-                        print(f"Central wrote data to {target_device_name}: {data.decode()}")
-                        return True
-                    except Exception as e:
-                        print(f"Failed to write data to {target_device_name}: {e}")
-                        return False
-            print(f"Write characteristic not found for {target_device_name}.")
+        """把数据放入设备的发送队列（需要时先连接），由写入任务按 MTU 分块写出"""
+        if await self._ensure_connected(target_device_name):
+            queue = self.write_queues.get(target_device_name)
+            if queue is not None and queue.put(data):
+                return True
+            if queue is None or queue.closed:
+                print(f"Write queue for {target_device_name} is not running, dropping {len(data)} bytes.")
+            else:
+                print(f"Write queue for {target_device_name} is full, dropping {len(data)} bytes.")
             return False
         else:
             print(f"No active connection to device: {target_device_name}")
@@ -248,4 +651,5 @@ class BLEManager:
         asyncio.create_task(self._central_scanner_and_connector())
 
         while True:
-            await asyncio.sleep(5)
\ No newline at end of file
+            await asyncio.sleep(5)
+            await self._release_idle_connections()
\ No newline at end of file
@@ -19,6 +19,7 @@ SERVICE_UUID_CONFIG = bluetooth.UUID("0000FF00-0000-1000-8000-00805F9B34FB")
 CHAR_UUID_CONFIG_DATA = bluetooth.UUID("0000FF01-0000-1000-8000-00805F9B34FB") # 用于接收和发送配置数据 (JSON 字符串)
 
 
+# 主机要连接的设备在设置 "ble_devices" 中配置 (见 device_registry.py)，为空时使用下面两台
 # 主机要连接的设备1的UUID (假设已知)
 TARGET_DEVICE_1_NAME = "MyBLEDevice1"
 TARGET_DEVICE_1_SERVICE_UUID = bluetooth.UUID("00005678-0000-1000-8000-00805F9B34FB")
@@ -31,7 +32,46 @@ TARGET_DEVICE_2_SERVICE_UUID = bluetooth.UUID("00009A01-0000-1000-8000-00805F9B3
 TARGET_DEVICE_2_CHAR_UUID_WRITE = bluetooth.UUID("0000B2C3-0000-1000-8000-00805F9B34FB")
 TARGET_DEVICE_2_CHAR_UUID_NOTIFY = bluetooth.UUID("0000D4E5-0000-1000-8000-00805F9B34FB")
 
+# 主机连接槽位
+MAX_CENTRAL_CONNECTIONS = 3 # 控制器同时维持的主机连接数上限 (外设连接另算)
+ROTATING_SLOTS = 1 # 设备多于槽位时，留给按需设备轮流使用的槽位数
+ROTATE_IDLE_MS = 30000 # 按需连接空闲超过这个时间就释放槽位
+ON_DEMAND_CONNECT_TIMEOUT_MS = 15000 # 等待按需设备连上的时间
+RECONNECT_BASE_MS = 1000 # 连接失败后的第一次退避时间，之后每次翻倍
+RECONNECT_MAX_MS = 60000 # 退避时间上限
+RECONNECT_STABLE_MS = 10000 # 连接保持这么久之后才清零失败次数，更早断开按一次失败退避
+
+# 主机写入 (见 write_queue.py)
+BLE_MTU = 247 # 连接后请求的 ATT MTU
+WRITE_WINDOW = 8 # 每这么多次写入中有一次需要应答，用于流控
+WRITE_QUEUE_MAX = 32 # 每个设备的发送队列最多缓存的数据条数
+
+# 外设接收缓冲区 (见 ring_buffer.py)
+PERIPHERAL_RX_BUFFER_BYTES = 2048 # 环形缓冲区大小，突发写入在这里排队
+PERIPHERAL_RX_MAX_RECORD = 512 # 单次写入的最大长度 (ATT 属性值上限)
+
+# 上行批量帧 (见 uplink.py)
+UPLINK_BATCH_BYTES = 1024 # 一帧的最大字节数
+UPLINK_BATCH_DEADLINE_MS = 50 # 第一条通知进来后最多等待这么久就发出
+
 # BLE扫描参数
-SCAN_DURATION_MS = 5000 # 扫描持续时间
-SCAN_INTERVAL_US = 30000 # 扫描间隔
-SCAN_WINDOW_US = 30000 # 扫描窗口
+SCAN_INTERVAL_US = 30000 # 扫描间隔 (aggressive 档位，窗口 = 间隔即 100% 占空比)
+SCAN_WINDOW_US = 30000 # 扫描窗口 (所有档位共用)
+SCAN_SEARCH_INTERVAL_US = 90000 # search 档位的扫描间隔，约 33% 占空比
+SCAN_IDLE_INTERVAL_US = 600000 # idle 档位的扫描间隔，约 5% 占空比
+SCAN_EPOCH_MS = 5000 # 每轮扫描的时长，每轮开始时重新选择档位
+SCAN_BOOST_MS = 30000 # 目标断开后全速扫描的时间
+SCAN_STALE_MS = 60000 # 被动跟踪的锁超过这个时间没出现就提高占空比
+SCAN_RSSI_WEAK = -85 # 低于这个 RSSI 且仍在下降时提高占空比
+SCAN_RSSI_FALLING_DB = 3 # 快慢两条 RSSI 均值相差超过这个值视为在下降
+SEEN_CACHE_TTL_MS = 10000 # 同一地址的广播在这段时间内只处理/打印一次
+SEEN_CACHE_MAX = 128 # 去重缓存最多记录的地址数
+
+# --- Sesame 智能锁 (由 ESP32 直接登录和加解密，见 sesame_protocol.py) ---
+SESAME_SERVICE_UUID = bluetooth.UUID(0xFD81)
+SESAME_CHAR_UUID_WRITE = bluetooth.UUID("16860002-a5ae-9856-b6d3-dbb4c676993e")
+SESAME_CHAR_UUID_NOTIFY = bluetooth.UUID("16860003-a5ae-9856-b6d3-dbb4c676993e")
+# 目标设备中哪些是 Sesame 锁：设备名 -> device secret (hex)
+SESAME_LOCKS = {}
+SESAME_TIMEOUT_MS = 10000 # 等待 random code / 指令应答的时间
+SESAME_ADV_MAX_AGE_S = 300 # 超过这个时间没收到广播的锁从状态索引中删除
@@ -0,0 +1,162 @@
+# device_registry.py
+import time
+import bluetooth
+import config
+
+
+class TargetDevice:
+    """
+    一个主机模式目标设备。priority 越大越优先占用连接槽位。
+    device_id 是它在目标列表中的序号 (0-255)，用于上行批量帧，见 device_table()。
+    """
+    __slots__ = ("name", "service_uuid", "write_uuid", "notify_uuid", "priority", "device_id")
+
+    def __init__(self, name, service_uuid, write_uuid, notify_uuid, priority=0):
+        self.name = name
+        self.service_uuid = service_uuid
+        self.write_uuid = write_uuid
+        self.notify_uuid = notify_uuid
+        self.priority = priority
+        self.device_id = None
+
+    def __repr__(self):
+        return f"TargetDevice({self.name}, priority={self.priority})"
+
+
+def load_targets(settings_manager):
+    """
+    从设置 "ble_devices" 读取任意数量的目标设备，每项形如
+    {"name": ..., "service": ..., "write": ..., "notify": ..., "priority": 0}，UUID 为字符串。
+    Sesame 锁 (config.SESAME_LOCKS) 可以省略 UUID，没有列出的 Sesame 锁以优先级 0 自动加入。
+    设置为空时退回 config 中的 TARGET_DEVICE_1/2。返回按优先级从高到低排序的列表。
+    """
+    targets = []
+    for entry in settings_manager.get("ble_devices") or []:
+        try:
+            name = entry["name"]
+            if name in config.SESAME_LOCKS:
+                service = config.SESAME_SERVICE_UUID
+                write = config.SESAME_CHAR_UUID_WRITE
+                notify = config.SESAME_CHAR_UUID_NOTIFY
+            else:
+                service = bluetooth.UUID(entry["service"])
+                write = bluetooth.UUID(entry["write"])
+                notify = bluetooth.UUID(entry["notify"])
+            targets.append(TargetDevice(name, service, write, notify, entry.get("priority", 0)))
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"Ignoring invalid ble_devices entry {entry}: {e}")
+
+    if not targets:
+        targets = [
+            TargetDevice(config.TARGET_DEVICE_1_NAME, config.TARGET_DEVICE_1_SERVICE_UUID, config.TARGET_DEVICE_1_CHAR_UUID_WRITE, config.TARGET_DEVICE_1_CHAR_UUID_NOTIFY, 1),
+            TargetDevice(config.TARGET_DEVICE_2_NAME, config.TARGET_DEVICE_2_SERVICE_UUID, config.TARGET_DEVICE_2_CHAR_UUID_WRITE, config.TARGET_DEVICE_2_CHAR_UUID_NOTIFY, 1),
+        ]
+    names = [target.name for target in targets]
+    for name in config.SESAME_LOCKS:
+        if name not in names:
+            targets.append(TargetDevice(name, config.SESAME_SERVICE_UUID, config.SESAME_CHAR_UUID_WRITE, config.SESAME_CHAR_UUID_NOTIFY))
+
+    targets.sort(key=lambda target: target.priority, reverse=True)
+    for device_id, target in enumerate(targets[:256]):
+        target.device_id = device_id
+    if len(targets) > 256:
+        print(f"Only the first 256 of {len(targets)} targets are used.")
+        del targets[256:]
+    return targets
+
+
+def device_table(targets):
+    """设备名列表，下标就是设备 ID，发给服务器用来解析上行帧中的记录"""
+    return [target.name for target in targets]
+
+
+class SlotAllocator:
+    """
+    主机连接槽位分配。控制器最多同时维持 max_slots 个连接：
+    - 优先级最高的设备是常驻设备，各占一个槽位，扫描到就连接并保持连接；
+    - 其余设备按需连接 (request())，轮流使用剩下的 rotating 个槽位，
+      槽位满时让最久没用的按需设备让出，空闲超过 ROTATE_IDLE_MS 的按需连接会被释放。
+    时间都用 time.ticks_ms()，本类不做 I/O，断开连接由 BLEManager 完成。
+    """
+
+    def __init__(self, targets, max_slots=config.MAX_CENTRAL_CONNECTIONS, rotating=config.ROTATING_SLOTS):
+        self.max_slots = max_slots
+        # 设备数不超过槽位数时全部常驻，不需要轮换
+        resident_count = len(targets) if len(targets) <= max_slots else max_slots - rotating
+        self._resident = set(target.name for target in targets[:resident_count])
+        self.rotating_slots = max_slots - len(self._resident)
+        self._connected = {} # 设备名 -> 最近一次使用的 ticks_ms
+        self._demand = {} # 按需设备名 -> 请求时间 ticks_ms
+
+    def is_resident(self, name):
+        return name in self._resident
+
+    def wants(self, name):
+        """扫描到该设备时是否应该连接"""
+        if name in self._connected:
+            return False
+        return name in self._resident or name in self._demand
+
+    def missing(self):
+        """应该连接但还没连上的设备数，供扫描调度使用"""
+        count = 0
+        for name in self._resident:
+            if name not in self._connected:
+                count += 1
+        for name in self._demand:
+            if name not in self._connected:
+                count += 1
+        return count
+
+    def request(self, name, now):
+        """按需设备需要连接（例如有数据要写）；常驻设备不需要请求"""
+        if name not in self._resident and name not in self._connected:
+            self._demand[name] = now
+
+    def _rotating_in_use(self):
+        return [name for name in self._connected if name not in self._resident]
+
+    def victim(self, name):
+        """
+        为 name 腾出槽位前调用。有空闲槽位时返回 None；否则返回应该断开的
+        最久未用的按需设备。常驻设备总有自己的槽位，返回 None。
+        """
+        if name in self._resident:
+            return None
+        in_use = self._rotating_in_use()
+        if len(in_use) < self.rotating_slots:
+            return None
+        oldest = None
+        for other in in_use:
+            if oldest is None or time.ticks_diff(self._connected[oldest], self._connected[other]) > 0:
+                oldest = other
+        return oldest
+
+    def on_connected(self, name, now):
+        self._connected[name] = now
+        self._demand.pop(name, None)
+
+    def on_disconnected(self, name):
+        self._connected.pop(name, None)
+
+    def touch(self, name, now):
+        if name in self._connected:
+            self._connected[name] = now
+
+    def idle(self, now):
+        """空闲超过 ROTATE_IDLE_MS 的按需连接，应当释放"""
+        return [name for name in self._rotating_in_use()
+                if time.ticks_diff(now, self._connected[name]) > config.ROTATE_IDLE_MS]
+
+    def expire_demand(self, now):
+        """放弃超过 ON_DEMAND_CONNECT_TIMEOUT_MS 仍未连上的请求"""
+        for name in [n for n, t in self._demand.items() if time.ticks_diff(now, t) > config.ON_DEMAND_CONNECT_TIMEOUT_MS]:
+            del self._demand[name]
+
+    def stats(self):
+        return {
+            "max_slots": self.max_slots,
+            "resident": sorted(self._resident),
+            "connected": sorted(self._connected),
+            "pending": sorted(self._demand),
+        }
@@ -3,12 +3,15 @@ import uasyncio as asyncio
 import config
 import time
 import machine # 用于重启
+import ujson
 
 from event_bus import event_bus # 导入事件总线
 from settings_manager import settings_manager # 导入设置管理器实例
 from wifi_manager import connect_wifi # WiFi 连接现在直接是函数，或可以封装为类
 from mqtt_client import MQTTManager
 from ble_manager import BLEManager
+from uplink import UplinkBatcher
+from device_registry import device_table
 
 # 模块实例
 ble_manager_instance = None
@@ -42,16 +45,29 @@ async def main():
     async def handle_ble_peripheral_data(data):
         print(f"Main: Received BLE Peripheral data event: {data}")
         mqtt_topic = settings_manager.get("mqtt_pub_topic")
-        mqtt_manager_instance.publish(mqtt_topic, f"BLE_PERIPHERAL_RX:{data}")
+        mqtt_manager_instance.publish(mqtt_topic, b"BLE_PERIPHERAL_RX:" + data)
     event_bus.subscribe("ble_peripheral_data_received", handle_ble_peripheral_data)
 
-    # 2. 处理 BLE 主机接收到的通知：发布到 MQTT
-    async def handle_ble_central_notification(device_name, char_uuid, data):
-        print(f"Main: Received BLE Central notification event from {device_name} ({char_uuid}): {data}")
-        mqtt_topic = settings_manager.get("mqtt_pub_topic")
-        mqtt_manager_instance.publish(mqtt_topic, f"BLE_CENTRAL_NOTIFY_{device_name}:{data}")
+    # 2. 处理 BLE 主机接收到的通知：原始字节合并成批量帧发布到 MQTT
+    uplink_topic = settings_manager.get("mqtt_uplink_topic")
+    uplink = UplinkBatcher(lambda frame: mqtt_manager_instance.publish(uplink_topic, frame))
+    asyncio.create_task(uplink.run())
+
+    async def handle_ble_central_notification(device_name, device_id, data):
+        uplink.add(device_id, data)
     event_bus.subscribe("ble_central_notification_received", handle_ble_central_notification)
 
+    # Sesame 锁状态变化（已在 ESP32 上解密）：发布到 MQTT
+    async def handle_sesame_status(device_name, status):
+        mqtt_topic = settings_manager.get("mqtt_pub_topic")
+        mqtt_manager_instance.publish(mqtt_topic, f"SESAME_STATUS_{device_name}:{status['state']}")
+    event_bus.subscribe("sesame_status_changed", handle_sesame_status)
+
+    async def handle_sesame_adv_state(addr, state):
+        mqtt_topic = settings_manager.get("mqtt_pub_topic")
+        mqtt_manager_instance.publish(mqtt_topic, f"SESAME_ADV_{addr}:{state}")
+    event_bus.subscribe("sesame_adv_state_changed", handle_sesame_adv_state)
+
     # 3. 处理 MQTT 接收到的消息：转发到 BLE 主机或外设
     async def handle_mqtt_message_received(topic, msg):
         print(f"Main: Received MQTT message event: Topic='{topic}', Message='{msg}'")
@@ -62,9 +78,17 @@ async def main():
         elif msg_str.startswith("WRITE_DEV2:"):
             data_to_send = msg_str[len("WRITE_DEV2:"):].encode()
             await ble_manager_instance.central_write_data(config.TARGET_DEVICE_2_NAME, data_to_send)
+        elif msg_str.startswith("WRITE:"):
+            # WRITE:<设备名>:<数据>，设备名来自设置 ble_devices
+            device_name, _, payload = msg_str[len("WRITE:"):].partition(":")
+            await ble_manager_instance.central_write_data(device_name, payload.encode())
         elif msg_str.startswith("BLE_PERIPHERAL_TX:"):
             data_to_send = msg_str[len("BLE_PERIPHERAL_TX:"):].encode()
             await ble_manager_instance.peripheral_send_data(data_to_send)
+        elif msg_str.startswith("SESAME_LOCK:"):
+            await ble_manager_instance.sesame_command(msg_str[len("SESAME_LOCK:"):], "lock")
+        elif msg_str.startswith("SESAME_UNLOCK:"):
+            await ble_manager_instance.sesame_command(msg_str[len("SESAME_UNLOCK:"):], "unlock")
     event_bus.subscribe("mqtt_message_received", handle_mqtt_message_received)
 
     # 4. 处理设置更新事件：提示可能需要重启
@@ -84,6 +108,8 @@ async def main():
         print("Main: MQTT Connected event.")
         # 在这里订阅 MQTT topic，而不是在 MQTTManager 内部
         mqtt_manager_instance.subscribe(settings_manager.get("mqtt_sub_topic"))
+        # 上行帧中只有设备 ID，连接后先发布 ID -> 设备名对照表
+        mqtt_manager_instance.publish(uplink_topic + "/devices", ujson.dumps(device_table(ble_manager_instance.target_devices)))
     event_bus.subscribe("mqtt_connected", log_mqtt_connected)
 
     # --- 初始连接 WiFi ---
@@ -0,0 +1,125 @@
+# reconnect_supervisor.py
+import time
+import random
+import config
+
+
+class _DeviceState:
+    __slots__ = ("failures", "next_attempt", "disconnected_at", "connected_at", "connecting",
+                 "attempts", "successes", "last_latency_ms", "max_latency_ms")
+
+    def __init__(self):
+        self.failures = 0 # 连续失败次数，决定退避时间
+        self.next_attempt = None # ticks_ms，None 表示可以立即尝试
+        self.disconnected_at = None
+        self.connected_at = None
+        self.connecting = False
+        # 统计
+        self.attempts = 0
+        self.successes = 0
+        self.last_latency_ms = None
+        self.max_latency_ms = 0
+
+
+class ReconnectSupervisor:
+    """
+    所有主机重连的唯一决策者。扫描任务是唯一发起连接的地方，每次连接前问 due()，
+    连接结果用 on_connected() / on_failure() 报告，断开用 on_disconnected() 报告。
+
+    - 每个设备独立的指数退避：RECONNECT_BASE_MS * 2^(失败次数-1)，上限 RECONNECT_MAX_MS，
+      实际等待取 [delay/2, delay) 之间的随机值，避免多个设备同时重试；
+    - 连上后保持 RECONNECT_STABLE_MS 以上才断开的连接才清零失败次数，
+      连上就断的设备按失败继续退避，不会反复立即重连；
+    - 同一设备同时只会有一次连接在进行 (begin() 去重)；
+    - 统计每个设备的尝试次数和从断开到重新连上的耗时。
+    时间都用 time.ticks_ms()，本类不做 I/O。
+    """
+
+    def __init__(self):
+        self._devices = {}
+
+    def _state(self, name):
+        state = self._devices.get(name)
+        if state is None:
+            state = self._devices[name] = _DeviceState()
+        return state
+
+    def due(self, name, now):
+        """该设备现在是否可以尝试连接（不在退避中，也没有正在进行的连接）"""
+        state = self._devices.get(name)
+        if state is None:
+            return True
+        if state.connecting:
+            return False
+        return state.next_attempt is None or time.ticks_diff(now, state.next_attempt) >= 0
+
+    def begin(self, name, now):
+        """开始一次连接尝试；已有连接在进行时返回 False"""
+        if not self.due(name, now):
+            return False
+        state = self._state(name)
+        state.connecting = True
+        state.attempts += 1
+        if state.disconnected_at is None:
+            state.disconnected_at = now
+        return True
+
+    def on_connected(self, name, now):
+        """连接成功。失败次数要等连接稳定后（见 on_disconnected()）才清零"""
+        state = self._state(name)
+        state.connecting = False
+        state.next_attempt = None
+        state.connected_at = now
+        state.successes += 1
+        if state.disconnected_at is not None:
+            latency = time.ticks_diff(now, state.disconnected_at)
+            state.last_latency_ms = latency
+            if latency > state.max_latency_ms:
+                state.max_latency_ms = latency
+            state.disconnected_at = None
+
+    def on_failure(self, name, now):
+        """连接失败：按连续失败次数退避"""
+        state = self._state(name)
+        state.connecting = False
+        state.connected_at = None
+        return self._back_off(state, now)
+
+    def _back_off(self, state, now):
+        state.failures += 1
+        delay = min(config.RECONNECT_MAX_MS, config.RECONNECT_BASE_MS << min(state.failures - 1, 16))
+        half = delay // 2
+        state.next_attempt = time.ticks_add(now, half + random.getrandbits(16) % (half + 1))
+        return state.next_attempt
+
+    def on_disconnected(self, name, now):
+        """
+        连接断开：记录断开时间用于统计重连耗时。
+        连接保持了 RECONNECT_STABLE_MS 以上时清零失败次数，第一次重连不需要等待；
+        否则算一次失败，按失败次数退避。
+        """
+        state = self._state(name)
+        state.connecting = False
+        if state.disconnected_at is None:
+            state.disconnected_at = now
+        if state.connected_at is None:
+            return
+        if time.ticks_diff(now, state.connected_at) >= config.RECONNECT_STABLE_MS:
+            state.failures = 0
+            state.next_attempt = None
+        else:
+            self._back_off(state, now)
+        state.connected_at = None
+
+    def stats(self):
+        return {
+            name: {
+                "attempts": state.attempts,
+                "successes": state.successes,
+                "failures": state.failures,
+                "last_latency_ms": state.last_latency_ms,
+                "max_latency_ms": state.max_latency_ms,
+                "backoff": state.next_attempt is not None,
+            }
+            for name, state in self._devices.items()
+        }
@@ -0,0 +1,87 @@
+# ring_buffer.py
+import struct
+
+# 每条记录：来源 (uint8) | 长度 (uint16)，后接数据
+# MicroPython 的 struct 没有 Struct 类，只用格式字符串和 struct.pack_into/unpack_from
+_RECORD_HEADER = "<BH"
+_RECORD_HEADER_SIZE = struct.calcsize(_RECORD_HEADER)
+
+
+class RingBuffer:
+    """
+    构造时一次性分配的字节环形缓冲区，按条存放 (来源, 数据) 记录。
+    put() 在 BLE 写入回调一侧调用，get() 在消费任务一侧调用，都不分配新的缓冲区
+    （get() 返回指向内部暂存区的 memoryview，只在下一次 get() 之前有效）。
+    缓冲区放不下时 put() 返回 False 并计入 dropped，不会覆盖未读的数据。
+    """
+
+    def __init__(self, capacity, max_record=512):
+        self._buf = bytearray(capacity)
+        self._view = memoryview(self._buf)
+        self._capacity = capacity
+        self._head = 0 # 下一次写入的位置
+        self._tail = 0 # 下一次读取的位置
+        self._used = 0
+        self._header = bytearray(_RECORD_HEADER_SIZE)
+        self._header_view = memoryview(self._header)
+        self._scratch = bytearray(max_record)
+        self._scratch_view = memoryview(self._scratch)
+        self.max_record = max_record
+        # 统计
+        self.records = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def __len__(self):
+        """缓冲区中的记录字节数（含记录头）"""
+        return self._used
+
+    def _copy_in(self, data):
+        n = len(data)
+        first = min(n, self._capacity - self._head)
+        self._view[self._head:self._head + first] = data[:first]
+        if first < n:
+            self._view[0:n - first] = data[first:]
+        self._head = (self._head + n) % self._capacity
+
+    def _copy_out(self, dest, n):
+        first = min(n, self._capacity - self._tail)
+        dest[0:first] = self._view[self._tail:self._tail + first]
+        if first < n:
+            dest[first:n] = self._view[0:n - first]
+        self._tail = (self._tail + n) % self._capacity
+
+    def put(self, source, data):
+        """写入一条记录，成功返回 True"""
+        n = len(data)
+        size = _RECORD_HEADER_SIZE + n
+        if n > self.max_record or self._used + size > self._capacity:
+            self.dropped += 1
+            return False
+        struct.pack_into(_RECORD_HEADER, self._header, 0, source, n)
+        self._copy_in(self._header_view)
+        self._copy_in(memoryview(data))
+        self._used += size
+        self.records += 1
+        if self._used > self.high_water:
+            self.high_water = self._used
+        return True
+
+    def get(self):
+        """取出最早的一条记录 (来源, memoryview)，缓冲区为空时返回 None"""
+        if not self._used:
+            return None
+        self._copy_out(self._header_view, _RECORD_HEADER_SIZE)
+        source, n = struct.unpack_from(_RECORD_HEADER, self._header, 0)
+        self._copy_out(self._scratch_view, n)
+        self._used -= _RECORD_HEADER_SIZE + n
+        return source, self._scratch_view[:n]
+
+    def stats(self):
+        return {
+            "capacity": self._capacity,
+            "used": self._used,
+            "high_water": self.high_water,
+            "records": self.records,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,109 @@
+# scan_scheduler.py
+import time
+import config
+
+# 扫描档位，参数见 config.SCAN_*
+PROFILE_AGGRESSIVE = "aggressive"
+PROFILE_SEARCH = "search"
+PROFILE_IDLE = "idle"
+
+
+class _Tracked:
+    __slots__ = ("fast", "slow", "last_seen")
+
+    def __init__(self, rssi, now):
+        self.fast = rssi
+        self.slow = rssi
+        self.last_seen = now
+
+
+class ScanScheduler:
+    """
+    根据缺少的目标数、被动跟踪设备最近一次出现的时间和 RSSI 趋势选择扫描占空比，
+    并统计扫描实际占用的无线时间。
+
+    - aggressive: 断开后 SCAN_BOOST_MS 内，100% 占空比，尽快找回设备
+    - search:     还有目标没连上，或被动跟踪的锁太久没出现 / 信号在变弱
+    - idle:       全部连上且被动跟踪正常，低占空比，把无线时间留给 WiFi 和外设广播
+
+    所有时间都用 time.ticks_ms()，本类只做计算，由扫描任务在每一轮开始前调用 choose()。
+    """
+
+    def __init__(self):
+        self._profiles = {
+            PROFILE_AGGRESSIVE: (config.SCAN_INTERVAL_US, config.SCAN_WINDOW_US),
+            PROFILE_SEARCH: (config.SCAN_SEARCH_INTERVAL_US, config.SCAN_WINDOW_US),
+            PROFILE_IDLE: (config.SCAN_IDLE_INTERVAL_US, config.SCAN_WINDOW_US),
+        }
+        self._boost_until = None
+        self._tracked = {} # 地址 -> _Tracked
+        # 无线时间统计 (ms)
+        self.wall_ms = 0
+        self.radio_ms = 0
+        self.profile_ms = {name: 0 for name in self._profiles}
+
+    def boost(self, now):
+        """接下来 SCAN_BOOST_MS 内全速扫描（有目标断开，或按需设备等待连接）"""
+        self._boost_until = time.ticks_add(now, config.SCAN_BOOST_MS)
+
+    def on_disconnect(self, now):
+        self.boost(now)
+
+    def observe(self, addr, rssi, now):
+        """记录一个被跟踪设备（已配置且未连接的目标）的广播，用快慢两条 EMA 判断信号趋势"""
+        tracked = self._tracked.get(addr)
+        if tracked is None:
+            self._tracked[addr] = _Tracked(rssi, now)
+            return
+        tracked.fast += (rssi - tracked.fast) / 2
+        tracked.slow += (rssi - tracked.slow) / 8
+        tracked.last_seen = now
+
+    def forget(self, addr):
+        self._tracked.pop(addr, None)
+
+    def expire(self, now, max_age_ms):
+        """
+        停止跟踪 max_age_ms 内没有出现的设备。在 SCAN_STALE_MS 到 max_age_ms 之间
+        它们会让调度保持 search 去找回设备，之后视为已离开，允许回到 idle。
+        """
+        for addr in [a for a, t in self._tracked.items() if time.ticks_diff(now, t.last_seen) > max_age_ms]:
+            del self._tracked[addr]
+
+    def _needs_search(self, now):
+        for tracked in self._tracked.values():
+            if time.ticks_diff(now, tracked.last_seen) > config.SCAN_STALE_MS:
+                return True
+            # 信号偏弱且仍在下降：广播容易漏收，提高占空比
+            if tracked.fast < config.SCAN_RSSI_WEAK and tracked.fast < tracked.slow - config.SCAN_RSSI_FALLING_DB:
+                return True
+        return False
+
+    def choose(self, now, missing_targets):
+        """返回本轮扫描的 (档位名称, interval_us, window_us)"""
+        if self._boost_until is not None:
+            if time.ticks_diff(self._boost_until, now) > 0:
+                name = PROFILE_AGGRESSIVE
+            else:
+                self._boost_until = None
+        if self._boost_until is None:
+            name = PROFILE_SEARCH if missing_targets or self._needs_search(now) else PROFILE_IDLE
+        interval_us, window_us = self._profiles[name]
+        return name, interval_us, window_us
+
+    def account(self, name, elapsed_ms):
+        """一轮扫描结束后调用，按该档位的占空比累计无线时间"""
+        interval_us, window_us = self._profiles[name]
+        self.wall_ms += elapsed_ms
+        self.radio_ms += elapsed_ms * window_us // interval_us
+        self.profile_ms[name] += elapsed_ms
+
+    def stats(self):
+        return {
+            "wall_ms": self.wall_ms,
+            "radio_ms": self.radio_ms,
+            "saved_ms": self.wall_ms - self.radio_ms, # 相比一直 100% 扫描节省的无线时间
+            "duty_pct": self.radio_ms * 100 // self.wall_ms if self.wall_ms else 0,
+            "profile_ms": dict(self.profile_ms),
+            "tracked": len(self._tracked),
+        }
@@ -0,0 +1,283 @@
+# sesame_crypto.py
+"""
+Sesame 加密门面：登录 token (AES-CMAC) 和 CCM seal/open (4 字节 tag，1 字节 AAD)。
+
+桌面端 (s5WinApp.py) 和 ESP32 固件共用这一套接口，具体实现由可互换的后端提供。
+导入时按速度从快到慢依次尝试，选中第一个可用并通过已知向量自检的后端：
+
+    cryptography  >  pycryptodome  >  ucryptolib (MicroPython)  >  pure (AES_CCM)
+
+ucryptolib 只提供 AES-ECB，CMAC/CCM 部分复用 AES_CCM.py 中的 Python 实现，
+所以部署到 ESP32 时需要把 refSource/AES_CCM.py 一并放到 lib/ 目录下。
+"""
+try:
+    import AES_CCM
+except ImportError:  # 只有 ucryptolib / pure 后端需要
+    AES_CCM = None
+
+TAG_LEN = 4
+AAD = b"\x00"
+COUNTER_LEN = 9
+
+# AES_CCM.py __main__ 中的已知向量（与 refSource/log.txt 中真实设备的数据一致）
+KNOWN_VECTORS = {
+    "device_secret": bytes.fromhex("813f956d0729a31a8620271e23d90822"),
+    "random_code": bytes.fromhex("8e4b3f7c"),
+    "token": bytes.fromhex("a2e26d6ea935bf713ff7fa043bd56544"),
+    # (counter, plaintext, ciphertext || tag)
+    "seal": (0, bytes.fromhex("5303616263"), bytes.fromhex("0fe85988a1c8568b6b")),
+    "open": (0, bytes.fromhex("070200e4505d68"), bytes.fromhex("5be9380e92ef281570a55b")),
+}
+
+
+def make_nonce(counter, random_code):
+    """nonce = 计数器 (9 字节小端) || random_code (4 字节)"""
+    return counter.to_bytes(COUNTER_LEN, "little") + random_code
+
+
+class CryptoBackend:
+    """
+    后端基类。子类在 __init__ 中导入自己依赖的库，库不存在时抛出 ImportError。
+    """
+    name = None
+
+    def login_token(self, device_secret, random_code):
+        """返回 CMAC(device_secret, random_code)，即会话密钥"""
+        raise NotImplementedError
+
+    def new_session(self, session_key, random_code):
+        """返回带 seal(counter, plaintext) / open(counter, packet) 的会话对象"""
+        raise NotImplementedError
+
+
+class _NativeSession:
+    """
+    由原生 CCM 实现的会话。open() 认证失败时返回 None。
+    prefill()/discard_before()/retain() 与 AES_CCM.CCMSession 接口一致，原生实现无需预计算。
+    """
+
+    def __init__(self, random_code, seal, open_):
+        self.random_code = bytes(random_code)
+        self._seal = seal
+        self._open = open_
+
+    def seal(self, counter, plaintext):
+        return self._seal(make_nonce(counter, self.random_code), plaintext)
+
+    def open(self, counter, data):
+        if len(data) < TAG_LEN:
+            raise ValueError("Packet is shorter than the tag.")
+        return self._open(make_nonce(counter, self.random_code), data)
+
+    def prefill(self, counter, num_blocks=2):
+        return False
+
+    def discard_before(self, counter):
+        pass
+
+    def retain(self, *windows):
+        pass
+
+
+class _GlueBackend(CryptoBackend):
+    """只需要 AES-ECB 的后端：CMAC/CCM 由 AES_CCM 中的 Python 代码完成"""
+    cipher_class = None
+
+    def __init__(self):
+        if AES_CCM is None:
+            raise ImportError(f"AES_CCM is required by the '{self.name}' backend.")
+
+    def login_token(self, device_secret, random_code):
+        return AES_CCM.CMAC(device_secret, cipher_class=self.cipher_class).generate(random_code)
+
+    def new_session(self, session_key, random_code):
+        return AES_CCM.CCMSession(session_key, random_code, mac_len=TAG_LEN,
+                                  associated_data=AAD, cipher_class=self.cipher_class)
+
+
+# --- 后端注册表 ---
+_registry = []
+
+
+def register(backend_class):
+    """注册一个后端类。按注册顺序决定优先级，先注册的优先。"""
+    if backend_class not in _registry:
+        _registry.append(backend_class)
+    return backend_class
+
+
+@register
+class CryptographyBackend(CryptoBackend):
+    name = "cryptography"
+
+    def __init__(self):
+        from cryptography.hazmat.primitives.ciphers.aead import AESCCM
+        from cryptography.hazmat.primitives.ciphers import algorithms
+        from cryptography.hazmat.primitives.cmac import CMAC
+        from cryptography.exceptions import InvalidTag
+        self._aesccm = AESCCM
+        self._algorithms = algorithms
+        self._cmac = CMAC
+        self._invalid_tag = InvalidTag
+
+    def login_token(self, device_secret, random_code):
+        c = self._cmac(self._algorithms.AES(bytes(device_secret)))
+        c.update(bytes(random_code))
+        return c.finalize()
+
+    def new_session(self, session_key, random_code):
+        aead = self._aesccm(bytes(session_key), tag_length=TAG_LEN)
+        invalid_tag = self._invalid_tag
+
+        def open_(nonce, data):
+            try:
+                return aead.decrypt(nonce, bytes(data), AAD)
+            except invalid_tag:
+                return None
+
+        return _NativeSession(random_code, lambda nonce, pt: aead.encrypt(nonce, bytes(pt), AAD), open_)
+
+
+@register
+class PyCryptodomeBackend(CryptoBackend):
+    name = "pycryptodome"
+
+    def __init__(self):
+        from Crypto.Cipher import AES
+        from Crypto.Hash import CMAC
+        self._aes = AES
+        self._cmac = CMAC
+
+    def login_token(self, device_secret, random_code):
+        return self._cmac.new(bytes(device_secret), bytes(random_code), ciphermod=self._aes).digest()
+
+    def new_session(self, session_key, random_code):
+        aes = self._aes
+        key = bytes(session_key)
+
+        def seal(nonce, plaintext):
+            cobj = aes.new(key, aes.MODE_CCM, nonce=nonce, mac_len=TAG_LEN)
+            cobj.update(AAD)
+            ciphertext, tag = cobj.encrypt_and_digest(bytes(plaintext))
+            return ciphertext + tag
+
+        def open_(nonce, data):
+            cobj = aes.new(key, aes.MODE_CCM, nonce=nonce, mac_len=TAG_LEN)
+            cobj.update(AAD)
+            try:
+                return cobj.decrypt_and_verify(bytes(data[:-TAG_LEN]), bytes(data[-TAG_LEN:]))
+            except ValueError:
+                return None
+
+        return _NativeSession(random_code, seal, open_)
+
+
+@register
+class UcryptolibBackend(_GlueBackend):
+    name = "ucryptolib"
+
+    def __init__(self):
+        _GlueBackend.__init__(self)
+        try:
+            import cryptolib as ucryptolib
+        except ImportError:
+            import ucryptolib
+
+        class _ECB:
+            BLOCK_SIZE = 16
+
+            def __init__(self, key):
+                # mode 1 = ECB；同一个对象可以连续加密多个块
+                self._aes = ucryptolib.aes(bytes(key), 1)
+                self.encrypt_block = self._aes.encrypt
+
+            def encrypt_into(self, src, dst):
+                # 结果直接写进 dst（可以和 src 是同一个缓冲区），CCMSession.seal_into/open_into 不再分配
+                self._aes.encrypt(src, dst)
+
+        self.cipher_class = _ECB
+
+
+@register
+class PurePythonBackend(_GlueBackend):
+    name = "pure"
+
+    def __init__(self):
+        _GlueBackend.__init__(self)
+        self.cipher_class = AES_CCM.TTableAES
+
+
+def self_test(backend):
+    """用已知向量检查后端。全部通过返回 True。"""
+    v = KNOWN_VECTORS
+    try:
+        token = backend.login_token(v["device_secret"], v["random_code"])
+        if token != v["token"]:
+            return False
+        session = backend.new_session(token, v["random_code"])
+        counter, plaintext, packet = v["seal"]
+        if session.seal(counter, plaintext) != packet:
+            return False
+        counter, plaintext, packet = v["open"]
+        if session.open(counter, packet) != plaintext:
+            return False
+        # 计数器不匹配的包必须被拒绝
+        if session.open(counter + 1, packet) is not None:
+            return False
+    except Exception as e:
+        print(f"Sesame crypto backend '{backend.name}' self-test error: {e}")
+        return False
+    return True
+
+
+def available_backends():
+    """返回当前环境中能导入的后端名称（按优先级排列）"""
+    names = []
+    for backend_class in _registry:
+        try:
+            backend_class()
+        except ImportError:
+            continue
+        names.append(backend_class.name)
+    return names
+
+
+def get_backend(name):
+    """按名称实例化一个后端，并要求通过自检"""
+    for backend_class in _registry:
+        if backend_class.name == name:
+            b = backend_class()
+            if not self_test(b):
+                raise RuntimeError(f"Sesame crypto backend '{name}' failed the self-test.")
+            return b
+    raise ValueError(f"Unknown Sesame crypto backend: {name}")
+
+
+def _select_backend():
+    for backend_class in _registry:
+        try:
+            b = backend_class()
+        except ImportError:
+            continue
+        if self_test(b):
+            return b
+        print(f"Sesame crypto backend '{b.name}' failed the self-test, skipped.")
+    raise RuntimeError("No usable Sesame crypto backend.")
+
+
+backend = _select_backend()
+
+
+def use_backend(name):
+    """切换当前使用的后端"""
+    global backend
+    backend = get_backend(name)
+    return backend
+
+
+def login_token(device_secret, random_code):
+    return backend.login_token(device_secret, random_code)
+
+
+def new_session(session_key, random_code):
+    return backend.new_session(session_key, random_code)
@@ -0,0 +1,450 @@
+# sesame_protocol.py
+"""
+Sesame BLE 协议层：分片重组与发送分片、推送消息的解码，以及不做 I/O 的协议状态机 SesameProtocol。
+
+每个 BLE 包的第一个字节是分片头：
+    bit0     : 1 = 消息的第一个分片
+    bit1-2   : 0 = 后面还有分片，1 = 明文消息结束，2 = 加密消息结束
+
+所以单分片的明文消息以 0x03 开头，加密消息以 0x05 开头。
+SesameProtocol 只处理字节：收到的分片喂给 receive()，要写出的分片由 login_request() / command() 返回。
+具体的收发由各个传输适配器完成：桌面端 s5WinApp.SesameController (bleak)、
+ESP32 固件 ble_manager.SesameLink (aioble)、sesame_sim.SimulatedClient (内存链路)。
+"""
+import struct
+
+# --- Sesame GATT ---
+SESAME_SERVICE_UUID16 = 0xFD81
+CMD_CHARACTERISTIC_UUID = "16860002-a5ae-9856-b6d3-dbb4c676993e"
+STATUS_CHARACTERISTIC_UUID = "16860003-a5ae-9856-b6d3-dbb4c676993e"
+
+# --- 消息类型和 item code ---
+MSG_TYPE_AUTH_FAILED = 0  # 伪类型：receive() 解密失败时返回，会话已不可用
+MSG_TYPE_RESPONSE = 7
+MSG_TYPE_PUBLISH = 8
+ITEM_CODE_LOGIN = 2
+ITEM_CODE_HISTORY = 4
+ITEM_CODE_VERSION = 5
+ITEM_CODE_RANDOM_CODE = 14
+ITEM_CODE_SETTING = 80
+ITEM_CODE_MECH_STATUS = 81
+ITEM_CODE_LOCK = 82
+ITEM_CODE_UNLOCK = 83
+RESULT_SUCCESS = 0
+RESULT_NOT_FOUND = 5  # 例如没有更多历史记录
+
+RANDOM_CODE_LEN = 4
+PINCODE_LEN = 4
+
+SEGMENT_START = 0x01
+SEGMENT_CONTINUE = 0
+SEGMENT_PLAIN_END = 1
+SEGMENT_CIPHER_END = 2
+
+HEADER_PLAIN = SEGMENT_START | (SEGMENT_PLAIN_END << 1)    # 0x03
+HEADER_ENCRYPTED = SEGMENT_START | (SEGMENT_CIPHER_END << 1)  # 0x05
+
+# 默认 ATT MTU 23 时一次写入 20 字节，去掉分片头后每片 19 字节负载
+DEFAULT_FRAGMENT_LEN = 19
+# 一条完整消息（加密时含 4 字节 tag）的上限，决定重组缓冲区大小
+MAX_MESSAGE_LEN = 512
+
+
+class Reassembler:
+    """
+    把一串通知分片拼成完整消息。每个会话一个实例，缓冲区在构造时一次性分配。
+
+    feed() 返回 (encrypted, message)，message 是指向内部缓冲区的 memoryview，
+    只在下一次 feed() 之前有效；需要保留时由调用方复制。
+    """
+
+    def __init__(self, max_len=MAX_MESSAGE_LEN):
+        self._buf = bytearray(max_len)
+        self._view = memoryview(self._buf)
+        self._len = 0
+        self._active = False
+        # 统计
+        self.messages = 0
+        self.dropped = 0    # 未结束就被新消息打断，或没有起始分片的续片
+        self.overflows = 0  # 超过 max_len 的消息
+
+    def reset(self):
+        """丢弃未完成的消息（例如断开重连后）"""
+        self._len = 0
+        self._active = False
+
+    def feed(self, fragment):
+        """喂入一个分片。消息完整时返回 (encrypted, message)，否则返回 None。"""
+        if not fragment:
+            return None
+        header = fragment[0]
+        n = len(fragment) - 1
+
+        if header & SEGMENT_START:
+            if self._active:
+                self.dropped += 1
+            self._len = 0
+            self._active = True
+        elif not self._active:
+            # 起始分片丢了，或者之前溢出了：等下一条消息的起始分片
+            self.dropped += 1
+            return None
+
+        if self._len + n > len(self._buf):
+            self.overflows += 1
+            self.reset()
+            return None
+        self._buf[self._len:self._len + n] = memoryview(fragment)[1:]
+        self._len += n
+
+        end = (header >> 1) & 0x03
+        if end == SEGMENT_CONTINUE:
+            return None
+        self._active = False
+        self.messages += 1
+        return end == SEGMENT_CIPHER_END, self._view[:self._len]
+
+
+def segment(payload, encrypted, fragment_len=DEFAULT_FRAGMENT_LEN):
+    """把一条消息切成带分片头的 BLE 包，逐个产出 bytes"""
+    total = len(payload)
+    end = SEGMENT_CIPHER_END if encrypted else SEGMENT_PLAIN_END
+    pos = 0
+    while True:
+        chunk = payload[pos:pos + fragment_len]
+        header = SEGMENT_START if pos == 0 else 0
+        pos += fragment_len
+        if pos >= total:
+            yield bytes([header | (end << 1)]) + chunk
+            return
+        yield bytes([header]) + chunk
+
+
+# 机械状态推送 (8/81) 的负载：电池 (uint16) | 目标位置 (int16) | 当前位置 (int16) | 标志 (uint8)
+# MicroPython 的 struct 没有 Struct 类，这里只用格式字符串和模块级函数
+_MECH_STATUS = "<HhhB"
+
+MECH_FLAG_CLUTCH_FAILED = 0x01
+MECH_FLAG_LOCK_RANGE = 0x02
+MECH_FLAG_UNLOCK_RANGE = 0x04
+MECH_FLAG_CRITICAL = 0x08
+MECH_FLAG_STOP = 0x10
+MECH_FLAG_BATTERY_CRITICAL = 0x20
+MECH_FLAG_CLOCKWISE = 0x40
+
+
+class MechStatus:
+    """一次机械状态推送。target 为 -32768 表示没有目标位置。"""
+    __slots__ = ("battery", "target", "position", "flags")
+    SIZE = struct.calcsize(_MECH_STATUS)
+
+    def __init__(self, battery, target, position, flags):
+        self.battery = battery
+        self.target = target
+        self.position = position
+        self.flags = flags
+
+    @classmethod
+    def unpack(cls, payload, offset=0):
+        battery, target, position, flags = struct.unpack_from(_MECH_STATUS, payload, offset)
+        return cls(battery, target, position, flags)
+
+    def pack(self):
+        return struct.pack(_MECH_STATUS, self.battery, self.target, self.position, self.flags)
+
+    @property
+    def state(self):
+        """'locked' / 'unlocked' / 'moving'"""
+        if self.flags & MECH_FLAG_LOCK_RANGE:
+            return "locked"
+        if self.flags & MECH_FLAG_UNLOCK_RANGE:
+            return "unlocked"
+        return "moving"
+
+    @property
+    def voltage(self):
+        """电池电压 (V)，原始值单位为 2 mV"""
+        return self.battery * 2 / 1000
+
+    def as_dict(self):
+        return {
+            "state": self.state,
+            "battery": self.battery,
+            "target": self.target,
+            "position": self.position,
+            "flags": self.flags,
+        }
+
+    def __eq__(self, other):
+        return (isinstance(other, MechStatus) and self.battery == other.battery
+                and self.target == other.target and self.position == other.position
+                and self.flags == other.flags)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return "MechStatus(state=%s, battery=%d, target=%d, position=%d, flags=0x%02x)" % (
+            self.state, self.battery, self.target, self.position, self.flags)
+
+
+# --- 广播 ---
+# CANDY HOUSE 的 Bluetooth SIG 公司 ID，Sesame 的厂商数据以它开头
+SESAME_COMPANY_ID = 0x055A
+# 厂商数据（去掉公司 ID 后）：产品型号 (uint8) | 保留 (uint8) | 标志 (uint8) | device id (16 字节)
+_ADVERTISEMENT = "<BBB"
+_ADVERTISEMENT_SIZE = struct.calcsize(_ADVERTISEMENT)
+DEVICE_ID_LEN = 16
+
+ADV_FLAG_REGISTERED = 0x01
+ADV_FLAG_LOCK_RANGE = 0x02
+ADV_FLAG_UNLOCK_RANGE = 0x04
+ADV_FLAG_TAG = 0x80  # 每次状态变化（开关锁、新历史记录）时翻转
+
+
+class Advertisement:
+    """一条 Sesame 广播的厂商数据，不需要连接和登录就能读到"""
+    __slots__ = ("product_model", "flags", "device_id")
+
+    def __init__(self, product_model, flags, device_id=b""):
+        self.product_model = product_model
+        self.flags = flags
+        self.device_id = device_id
+
+    @classmethod
+    def decode(cls, data):
+        """解码厂商数据（不含公司 ID）；长度不够时返回 None"""
+        if len(data) < _ADVERTISEMENT_SIZE:
+            return None
+        product_model, _, flags = struct.unpack_from(_ADVERTISEMENT, data, 0)
+        start = _ADVERTISEMENT_SIZE
+        return cls(product_model, flags, bytes(data[start:start + DEVICE_ID_LEN]))
+
+    def encode(self):
+        return struct.pack(_ADVERTISEMENT, self.product_model, 0, self.flags) + self.device_id
+
+    @property
+    def registered(self):
+        return bool(self.flags & ADV_FLAG_REGISTERED)
+
+    @property
+    def state(self):
+        """'locked' / 'unlocked' / 'moving'，与 MechStatus.state 一致"""
+        if self.flags & ADV_FLAG_LOCK_RANGE:
+            return "locked"
+        if self.flags & ADV_FLAG_UNLOCK_RANGE:
+            return "unlocked"
+        return "moving"
+
+    def __repr__(self):
+        return "Advertisement(model=%d, state=%s, flags=0x%02x)" % (
+            self.product_model, self.state, self.flags)
+
+
+class _AdvertisedLock:
+    __slots__ = ("advertisement", "rssi", "last_seen", "changed")
+
+    def __init__(self, advertisement, rssi, now):
+        self.advertisement = advertisement
+        self.rssi = rssi
+        self.last_seen = now
+        self.changed = now
+
+
+class AdvertisementIndex:
+    """
+    地址 -> 最近一次广播的索引，被动监听锁的状态，不占用连接。
+    时间戳由调用方传入，必须单调递增且不回绕（ESP32 上用 time.time()，
+    不能用会回绕的 ticks_ms()；桌面端可以用 time.monotonic()），本类不读时钟。
+    """
+
+    def __init__(self):
+        self._locks = {}
+
+    def update(self, address, manufacturer_data, rssi, now):
+        """
+        记录一条广播。状态或 tag 与上次不同时（包括第一次见到）返回新的 Advertisement，
+        否则返回 None；无法解码时也返回 None。
+        """
+        adv = Advertisement.decode(manufacturer_data)
+        if adv is None:
+            return None
+        entry = self._locks.get(address)
+        if entry is None:
+            self._locks[address] = _AdvertisedLock(adv, rssi, now)
+            return adv
+        entry.rssi = rssi
+        entry.last_seen = now
+        if adv.flags == entry.advertisement.flags:
+            return None
+        entry.advertisement = adv
+        entry.changed = now
+        return adv
+
+    def get(self, address):
+        """返回 (Advertisement, rssi, last_seen, changed)，没见过时返回 None"""
+        entry = self._locks.get(address)
+        if entry is None:
+            return None
+        return entry.advertisement, entry.rssi, entry.last_seen, entry.changed
+
+    def state(self, address):
+        entry = self._locks.get(address)
+        return None if entry is None else entry.advertisement.state
+
+    def expire(self, now, max_age):
+        """删除 max_age 内没有再收到广播的锁，返回删除的地址列表"""
+        stale = [address for address, entry in self._locks.items() if now - entry.last_seen > max_age]
+        for address in stale:
+            del self._locks[address]
+        return stale
+
+    def __len__(self):
+        return len(self._locks)
+
+    def __contains__(self, address):
+        return address in self._locks
+
+
+_MSG_HEADER = "<BB"  # (消息类型, item code)
+_MSG_HEADER_SIZE = struct.calcsize(_MSG_HEADER)
+
+
+class Message:
+    """
+    receive() 产出的一条完整消息。body 是 item code 之后的内容（memoryview，
+    明文消息指向重组缓冲区，in_place 模式下解密的消息指向解密缓冲区，只在下一次 receive() 之前有效）。
+    应答消息 (7, *) 的 body = 结果码 || 负载。
+    """
+    __slots__ = ("msg_type", "item_code", "body")
+
+    def __init__(self, msg_type, item_code, body):
+        self.msg_type = msg_type
+        self.item_code = item_code
+        self.body = body
+
+    @property
+    def result(self):
+        return self.body[0] if len(self.body) else RESULT_SUCCESS
+
+    @property
+    def payload(self):
+        return self.body[1:]
+
+
+class SesameProtocol:
+    """
+    一条连接上的 Sesame 协议状态：分片重组、random code、登录、tx/rx 计数器和 CCM。
+    不做任何 I/O，也不依赖事件循环，可以在 bleak、aioble 或内存链路上复用。
+
+    crypto 是提供 login_token(secret, random_code) / new_session(key, random_code) 的对象，
+    默认是 sesame_crypto 模块。
+
+    in_place=True 时（ESP32 固件），会话支持 seal_into()/open_into() 的话就用它们加解密到
+    构造时分配好的缓冲区，encode()/decode() 返回指向缓冲区的 memoryview，只在下一次调用前有效。
+    """
+
+    def __init__(self, device_secret, crypto=None, fragment_len=DEFAULT_FRAGMENT_LEN,
+                 max_message_len=MAX_MESSAGE_LEN, in_place=False):
+        if crypto is None:
+            import sesame_crypto as crypto
+        self.device_secret = bytes(device_secret)
+        self.crypto = crypto
+        self.fragment_len = fragment_len
+        self.reassembler = Reassembler(max_message_len)
+        self.in_place = in_place
+        if in_place:
+            self._packet_buf = bytearray(max_message_len)
+            self._plain_buf = bytearray(max_message_len)
+        self.auth_failures = 0
+        self.reset()
+
+    def reset(self):
+        """新连接或断开后调用：丢弃未完成的分片和 random code，等待锁重新推送"""
+        self.reassembler.reset()
+        self.random_code = None
+        self.end_session()
+
+    def end_session(self):
+        self.session = None
+        self._into = False
+        self.session_key = None
+        self.tx_counter = 0
+        self.rx_counter = 0
+        self.logged_in = False
+
+    def start_session(self):
+        """用当前 random code 派生会话密钥 (CMAC)，tx/rx 计数器从 0 开始"""
+        if self.random_code is None:
+            raise ValueError("No random code received yet.")
+        self.end_session()
+        self.session_key = self.crypto.login_token(self.device_secret, self.random_code)
+        # 会话期间复用同一个 CCM 上下文（密钥扩展和 B0/A0 模板只计算一次）
+        self.session = self.crypto.new_session(self.session_key, self.random_code)
+        self._into = self.in_place and hasattr(self.session, "seal_into")
+
+    def login_request(self):
+        """返回登录指令的分片（明文：item code 2 || token 前 4 字节）"""
+        if self.session is None:
+            raise ValueError("start_session() must be called before login_request().")
+        return self._fragments(bytes([ITEM_CODE_LOGIN]) + self.session_key[:PINCODE_LEN], False)
+
+    def command(self, item_code, parameter=b""):
+        """加密一条指令并返回它的分片，tx 计数器加 1。分片必须按返回顺序写出。"""
+        if self.session is None:
+            raise ValueError("Not logged in.")
+        packet = self.encode(bytes([item_code]) + parameter)
+        self.tx_counter += 1
+        return self._fragments(packet, True)
+
+    def _fragments(self, message, encrypted):
+        return list(segment(message, encrypted, self.fragment_len))
+
+    def encode(self, data):
+        if self._into:
+            n = self.session.seal_into(self.tx_counter, data, self._packet_buf)
+            return memoryview(self._packet_buf)[:n]
+        return self.session.seal(self.tx_counter, data)
+
+    def decode(self, data):
+        """返回解密后的明文；认证失败时返回 None"""
+        if self._into:
+            n = self.session.open_into(self.rx_counter, data, self._plain_buf)
+            return memoryview(self._plain_buf)[:n] if n >= 0 else None
+        return self.session.open(self.rx_counter, data)
+
+    def receive(self, fragment):
+        """
+        喂入一个通知分片。消息完整时返回 Message，否则返回 None。
+        解密失败时结束会话并返回 MSG_TYPE_AUTH_FAILED 消息，调用方应断开重连。
+        相同的 random code 重复推送时返回 None；新的 random code 会结束当前会话。
+        """
+        complete = self.reassembler.feed(fragment)
+        if complete is None:
+            return None
+        encrypted, message = complete
+        if encrypted:
+            if self.session is None:
+                return None
+            message = self.decode(message)
+            self.rx_counter += 1
+            if message is None:
+                self.auth_failures += 1
+                self.end_session()
+                return Message(MSG_TYPE_AUTH_FAILED, 0, memoryview(b""))
+        if len(message) < _MSG_HEADER_SIZE:
+            return None
+        msg_type, item_code = struct.unpack_from(_MSG_HEADER, message, 0)
+        body = memoryview(message)[_MSG_HEADER_SIZE:]
+
+        if msg_type == MSG_TYPE_PUBLISH and item_code == ITEM_CODE_RANDOM_CODE:
+            if len(body) < RANDOM_CODE_LEN:
+                return None
+            random_code = bytes(body[:RANDOM_CODE_LEN])
+            if random_code == self.random_code:
+                return None
+            self.end_session()
+            self.random_code = random_code
+        elif msg_type == MSG_TYPE_RESPONSE and item_code == ITEM_CODE_LOGIN:
+            self.logged_in = self.session is not None and (not len(body) or body[0] == RESULT_SUCCESS)
+        return Message(msg_type, item_code, body)
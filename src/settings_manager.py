@@ -13,7 +13,10 @@ DEFAULT_SETTINGS = {
     "mqtt_client_id": "esp32_default_client",
     "mqtt_pub_topic": "esp32/data",
     "mqtt_sub_topic": "esp32/cmd",
-    "sensor_read_interval_s": 60
+    "mqtt_uplink_topic": "esp32/uplink", # 通知批量帧 (二进制)，设备 ID 表发布在 <topic>/devices
+    "sensor_read_interval_s": 60,
+    # 主机模式目标设备列表，见 device_registry.load_targets()
+    "ble_devices": []
 }
 
 class SettingsManager:
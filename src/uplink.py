@@ -0,0 +1,80 @@
+# uplink.py
+import struct
+import uasyncio as asyncio
+import config
+
+# 批量上行帧：帧头 (版本, 记录数)，后接若干记录 (设备 ID, 数据长度) + 原始通知字节
+FRAME_VERSION = 1
+# MicroPython 的 struct 没有 Struct 类，只用格式字符串和 struct.pack_into
+_FRAME_HEADER = "<BB"
+_FRAME_HEADER_SIZE = struct.calcsize(_FRAME_HEADER)
+_RECORD_HEADER = "<BH"
+_RECORD_HEADER_SIZE = struct.calcsize(_RECORD_HEADER)
+MAX_RECORDS = 255
+
+
+class UplinkBatcher:
+    """
+    把所有主机连接收到的通知原样（不解码）合并成批量帧，一帧一次 MQTT 发布。
+    帧写在构造时分配好的缓冲区里，攒满 max_bytes / MAX_RECORDS 条，或第一条记录进来后
+    过了 deadline_ms 就发出。publish(frame) 是同步调用，frame 是指向内部缓冲区的
+    memoryview，返回后缓冲区会被复用。
+    """
+
+    def __init__(self, publish, max_bytes=config.UPLINK_BATCH_BYTES, deadline_ms=config.UPLINK_BATCH_DEADLINE_MS):
+        self._publish = publish
+        self._buf = bytearray(max_bytes)
+        self._view = memoryview(self._buf)
+        self._deadline_ms = deadline_ms
+        self._len = _FRAME_HEADER_SIZE
+        self._count = 0
+        self._pending = asyncio.Event()
+        # 统计
+        self.frames = 0
+        self.records = 0
+        self.bytes = 0
+        self.oversized = 0 # 单条就放不进缓冲区、被丢弃的通知
+
+    def add(self, device_id, data):
+        """加入一条通知；放不下时先把已有的记录发出"""
+        size = _RECORD_HEADER_SIZE + len(data)
+        if _FRAME_HEADER_SIZE + size > len(self._buf):
+            self.oversized += 1
+            print(f"Uplink: dropping {len(data)}-byte notification from device {device_id}, larger than a frame.")
+            return
+        if self._len + size > len(self._buf) or self._count >= MAX_RECORDS:
+            self.flush()
+        struct.pack_into(_RECORD_HEADER, self._buf, self._len, device_id, len(data))
+        start = self._len + _RECORD_HEADER_SIZE
+        self._buf[start:start + len(data)] = data
+        self._len = start + len(data)
+        self._count += 1
+        if self._count == 1:
+            self._pending.set()
+
+    def flush(self):
+        if not self._count:
+            return
+        struct.pack_into(_FRAME_HEADER, self._buf, 0, FRAME_VERSION, self._count)
+        self._publish(self._view[:self._len])
+        self.frames += 1
+        self.records += self._count
+        self.bytes += self._len
+        self._len = _FRAME_HEADER_SIZE
+        self._count = 0
+
+    async def run(self):
+        """截止时间到了就发出未满的帧"""
+        while True:
+            await self._pending.wait()
+            self._pending.clear()
+            await asyncio.sleep_ms(self._deadline_ms)
+            self.flush()
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "records": self.records,
+            "bytes": self.bytes,
+            "oversized": self.oversized,
+        }
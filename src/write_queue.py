@@ -0,0 +1,133 @@
+# write_queue.py
+import uasyncio as asyncio
+from collections import deque
+from micropython import const
+import config
+
+# aioble ClientCharacteristic.properties 中的 GATT 特性属性位
+_FLAG_WRITE_NO_RESPONSE = const(0x0004)
+_FLAG_WRITE = const(0x0008)
+
+ATT_HEADER_LEN = 3 # ATT Write 请求的 opcode + handle
+STALL_RETRY_MS = 10 # 只支持 write-without-response 时，控制器缓冲区满后等待多久重试
+STALL_RETRIES = 50
+
+
+class DeviceWriteQueue:
+    """
+    一个主机连接的发送队列和写入任务。
+    - 连接后先协商 ATT MTU，每次写入 MTU - 3 字节，较长的数据拆成多次写入；
+    - 连续 write-without-response，每 WRITE_WINDOW 次改用一次需要应答的写入，
+      等对方确认后再继续，避免突发数据把控制器缓冲区写满；
+      写入方式按特性的属性选择：只支持应答写入的每次都等应答，
+      只支持 write-without-response 的不做应答写入，缓冲区满时稍等再重试；
+    - 写特性在连接时解析一次并缓存在这里。
+    put() 只入队不等待，队列满 (WRITE_QUEUE_MAX 条) 或写入任务已经退出时返回 False 由调用方处理。
+    """
+
+    def __init__(self, device_name, connection, char, window=config.WRITE_WINDOW, max_pending=config.WRITE_QUEUE_MAX):
+        self.device_name = device_name
+        self.connection = connection
+        self.char = char
+        self.window = window
+        self.max_pending = max_pending
+        self.mtu = 23 # 协商前的默认 ATT MTU
+        self._can_ack = bool(char.properties & _FLAG_WRITE)
+        self._can_unack = bool(char.properties & _FLAG_WRITE_NO_RESPONSE)
+        self._queue = deque((), max_pending)
+        self._ready = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._unacked = 0
+        self.closed = False # 写入任务退出后不再接受数据
+        # 统计
+        self.payloads = 0
+        self.writes = 0
+        self.acked_writes = 0
+        self.stalls = 0 # 控制器缓冲区满、需要重试的次数
+        self.rejected = 0 # 队列满被拒绝的数据
+
+    @property
+    def chunk_len(self):
+        return self.mtu - ATT_HEADER_LEN
+
+    def put(self, data):
+        if self.closed:
+            return False
+        if len(self._queue) >= self.max_pending:
+            self.rejected += 1
+            return False
+        self._queue.append(data)
+        self._idle.clear()
+        self._ready.set()
+        return True
+
+    async def drain(self):
+        """等待队列中的数据全部写出"""
+        await self._idle.wait()
+
+    async def _exchange_mtu(self):
+        try:
+            self.mtu = await self.connection.exchange_mtu(config.BLE_MTU)
+        except Exception as e:
+            print(f"MTU exchange with {self.device_name} failed, using {self.mtu}: {e}")
+        print(f"{self.device_name}: ATT MTU {self.mtu}, {self.chunk_len} bytes per write.")
+
+    async def _write(self, chunk):
+        self._unacked += 1
+        acked = not self._can_unack or (self._can_ack and self._unacked >= self.window)
+        retries = 0
+        while True:
+            try:
+                await self.char.write(chunk, acked)
+                break
+            except OSError:
+                if acked or retries >= STALL_RETRIES:
+                    raise
+                self.stalls += 1
+                retries += 1
+                if self._can_ack:
+                    # write-without-response 没有可用缓冲区：先用一次应答写入清空，再重试
+                    acked = True
+                else:
+                    await asyncio.sleep_ms(STALL_RETRY_MS)
+        self.writes += 1
+        if acked:
+            self.acked_writes += 1
+            self._unacked = 0
+
+    async def run(self):
+        """写入任务：连接断开或出错时退出"""
+        await self._exchange_mtu()
+        try:
+            while True:
+                if not self._queue:
+                    self._idle.set()
+                    self._ready.clear()
+                    await self._ready.wait()
+                    continue
+                data = self._queue.popleft()
+                view = memoryview(data)
+                step = self.chunk_len
+                for offset in range(0, len(view), step):
+                    await self._write(view[offset:offset + step])
+                self.payloads += 1
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"Write queue for {self.device_name} stopped: {e}")
+        finally:
+            self.closed = True
+            self._queue = deque((), self.max_pending)
+            self._idle.set()
+
+    def stats(self):
+        return {
+            "mtu": self.mtu,
+            "queued": len(self._queue),
+            "payloads": self.payloads,
+            "writes": self.writes,
+            "acked_writes": self.acked_writes,
+            "stalls": self.stalls,
+            "rejected": self.rejected,
+        }